@@ -1,4 +1,3 @@
-import time
 from pathlib import Path
 from datetime import datetime as dt
 
@@ -9,6 +8,7 @@ import seplanet.helpers.inventory as i
 import seplanet.helpers.orders as o
 import seplanet.helpers.earthengine as ee
 import seplanet.helpers.tools as t
+import seplanet.helpers.catalog as c
 
 
 class Daily():
@@ -25,7 +25,8 @@ class Daily():
             constellations=[
                         'PSScene4Band', 'PSScene3Band','PSOrthoTile','REOrthoTile', 'SkySatScene'
                        ],
-            out_projection='EPSG:4326'
+            out_projection='EPSG:4326',
+            score_profile=None
             
     ):
         
@@ -80,6 +81,12 @@ class Daily():
         # satellites
         self.constellations = constellations
         
+        # scoring profile (see inventory.SCORE_PROFILE)
+        self.score_profile = score_profile
+        
+        # refine index, built on first refine
+        self.refine_index = None
+        
         # gee delivery
         self.ee_cloud_project = None
         self.ee_image_collection = None
@@ -92,20 +99,90 @@ class Daily():
         # an empty order request dictionary that we fill later
         self.order_request = {}
         
-    def create_inventory(self):
+        # local registry of placed orders (title -> order id and state)
+        self.order_registry = self.project_dir.joinpath('order_registry.json')
+        
+        # local catalog of downloaded scenes
+        self.catalog_file = self.project_dir.joinpath('catalog.sqlite')
+        
+    def create_inventory(
+            self, 
+            shard_freq='YS', 
+            split_constellations=False, 
+            workers=4, 
+            cache=True, 
+            look_back=14,
+            stream=False,
+            aoi_tile_size=None
+    ):
+        
+        if cache:
+            # only search what is not yet in the local inventory cache
+            self.full_inventory, self.metadata_file = i.update_inventory(
+                self.aoi, 
+                self.start_date, 
+                self.end_date, 
+                self.max_cloud_cover, 
+                self.constellations,
+                self.client,
+                self.inventory_dir.joinpath('cache'),
+                look_back,
+                self.score_profile,
+                shard_freq,
+                split_constellations,
+                workers,
+                stream,
+                aoi_tile_size
+            )
+            
+        else:
+            # raw item metadata goes into a side store
+            self.metadata_file = self.inventory_dir.joinpath('full_inventory_metadata.jsonl')
+            self.metadata_file.unlink(missing_ok=True)
+            
+            # in streaming mode, chunks are appended to the inventory file directly
+            outfile = self.inventory_dir.joinpath('full_inventory.gpkg')
+            outfile.unlink(missing_ok=True)
 
-        self.full_inventory = i.create_inventory(
-            self.aoi, 
-            self.start_date, 
-            self.end_date, 
-            self.max_cloud_cover, 
-            self.constellations,
-            self.client
-        )
+            self.full_inventory = i.create_inventory(
+                self.aoi, 
+                self.start_date, 
+                self.end_date, 
+                self.max_cloud_cover, 
+                self.constellations,
+                self.client,
+                self.score_profile,
+                self.metadata_file,
+                shard_freq,
+                split_constellations,
+                workers,
+                stream,
+                outfile if stream else None,
+                aoi_tile_size
+            )
+            
+            if stream:
+                return
         
         # save full. inventory
         self.full_inventory.to_file(self.inventory_dir.joinpath('full_inventory.gpkg'), driver='GPKG')
         
+    def get_metadata(self, ids=None):
+        
+        # load raw item metadata on demand
+        return i.read_metadata(self.metadata_file, ids)
+        
+    def score_inventory(self, score_profile=None):
+        
+        # re-score the existing inventory without a new search
+        if score_profile is not None:
+            self.score_profile = score_profile
+            
+        self.full_inventory = i.add_score(self.full_inventory, self.score_profile)
+        
+        # scores are changed in place, so the refine index is outdated
+        self.refine_index = None
+        
     
     def refine_inventory(
             self, 
@@ -113,25 +190,43 @@ class Daily():
             scene_overlap=0, 
             aoi_overlap=0, 
             score=0, 
-            every=None
+            every=None,
+            save=False
     ):
         
-        self.refined_inventory = i.refine_inventory(
-            self.full_inventory, 
+        self.refined_inventory = self.get_refine_index().query(
             max_cloud_cover, 
             scene_overlap,
             aoi_overlap, 
             score,            
             every
         )
+        
+        if save:
+            self.save_refined_inventory()
+            
+    def sweep_inventory(self, coverage=True, **grid):
+        
+        # evaluate a grid of refine parameters (see inventory.InventoryIndex.sweep)
+        return self.get_refine_index().sweep(coverage, **grid)
+        
+    def save_refined_inventory(self):
     
         self.refined_inventory.to_file(self.inventory_dir.joinpath('refined_inventory.gpkg'), driver='GPKG')
     
+    def get_refine_index(self):
+        
+        # (re-)build index if the full inventory has changed
+        if self.refine_index is None or self.refine_index.gdf is not self.full_inventory:
+            self.refine_index = i.InventoryIndex(self.full_inventory, self.aoi)
+            
+        return self.refine_index
+    
     def plot_inventory(self, inventory_gdf, transparency=.1):
         i.plot_inventory(self.aoi, inventory_gdf, transparency)
         
         
-    def create_order(self, inventory_gdf, resubmit=False, ask=True):
+    def create_order(self, inventory_gdf, resubmit=False, ask=True, max_clip_bytes=50000):
         
         #-------------------------------------
         # 1 check on EE image collection and create if not there yet
@@ -166,7 +261,7 @@ class Daily():
 
         #-------------------------------------
         if 'composite' in self.tools:
-            self.composite_inventory = o.create_composite_gdf(self.aoi, self.inventory_gdf)
+            self.composite_inventory = i.create_composite_inventory(self.aoi, inventory_gdf)
             
             
         #-------------------------------------
@@ -182,17 +277,22 @@ class Daily():
             raise Exception(' Co-register tool is not practicable for orders of more than 500 images.')
             
         # if order has more than 500 items we split to avoid hitting the limitation
-        # therefore we loop over 500 rows 
+        # therefore we pack chunks of max. 500 items by item type, date and location
         every = 500
-        for idx, row in enumerate(range(0, nr_images, every)):
+        chunks = o.plan_orders(inventory_gdf, every)
+        
+        # keep the clip geometry within the payload budget
+        clip_aoi = t.simplify_aoi(self.aoi, max_clip_bytes)
+        
+        for idx, chunk in enumerate(chunks):
 
             # create order title
-            order_title = f'{self.project_name}_{idx}' if nr_images > every else self.project_name
+            order_title = f'{self.project_name}_{idx}' if len(chunks) > 1 else self.project_name
             
             # create the order
             self.order_request[order_title] = o.build_order(
-                self.aoi, 
-                inventory_gdf.iloc[row:row+every-1], 
+                clip_aoi, 
+                chunk, 
                 order_title, 
                 self.tools,
                 self.out_projection,
@@ -223,45 +323,54 @@ class Daily():
         
         #-------------------------------------
         # 5 Place order request(s)
-        # place each order request
-        for idx, order in enumerate(self.order_request.keys()):
-            print(f' Placing order {idx+1}/{len(self.order_request.keys())}')
-            o.place_order(
-                self.client, self.order_request[order], self.log_dir, resubmit
-            )
+        # place all order requests concurrently
+        print(f' Placing {len(self.order_request.keys())} order(s)')
+        self.order_results = o.place_orders(
+            self.client, self.order_request, self.log_dir, resubmit, self.order_registry
+        )
         #-------------------------------------
         
         
-    def download_order(self):
+    def download_order(self, workers=8, wait=True):
         
-        for order in self.order_request.keys():
-            o.download_order(self.client, order, self.download_dir, self.log_dir)
+        if wait:
+            # download each order as soon as it is ready
+            return o.watch_and_download(
+                self.client, 
+                self.order_registry, 
+                list(self.order_request.keys()),
+                self.download_dir,
+                self.log_dir,
+                workers
+            )
         
+        # download all orders at once
+        order_ids = o.resolve_order_ids(
+            self.client, self.order_registry, list(self.order_request.keys())
+        )
+        return o.download_orders(
+            self.client, order_ids, self.download_dir, self.log_dir, workers
+        )
         
-    def get_order_status(self, every_seconds=15):
         
+    def ingest(self, workers=4):
         
-        to_process = 999
-        while to_process > 0:
-    
-            states, titles = [], []
-            for title in self.order_request.keys():
-                
-                current_orders = o.get_existing_orders(self.client, pages=100)
-                order = [
-                    order for order in current_orders if title == order['name']
-                ][0]
-                print('Order: ' + title)
-                print('Last message: ' + order['last_message'])
-                states.append(order['state'])
-                titles.append(title)
-            if order['state'] not in ['success', 'partial', 'failed']:
-                time.sleep(15)
+        # extract deliveries and add the scenes to the local catalog
+        nr_scenes = c.ingest(self.download_dir, self.catalog_file, workers)
+        print(f'Added {nr_scenes} scenes to the local catalog at {self.catalog_file}.')
         
-            
-            to_process = len(
-                [state for state in states if state not in ['success', 'partial', 'failed']]
-            )
-            
+    def query_catalog(self, start_date=None, end_date=None, aoi=None):
+        
+        return c.query_catalog(self.catalog_file, start_date, end_date, aoi)
         
-        return [order for order in current_orders if order['name'] in titles]
\ No newline at end of file
+    def get_order_status(self, every_seconds=None, max_interval=300, min_interval=None):
+        
+        # poll the orders by id until all of them are done, every_seconds is 
+        # kept as alias of min_interval (default: depending on order state)
+        return o.poll_orders(
+            self.client, 
+            self.order_registry, 
+            list(self.order_request.keys()), 
+            min_interval or every_seconds, 
+            max_interval
+        )
@@ -0,0 +1,91 @@
+import json
+import hashlib
+from datetime import datetime as dt
+from datetime import timedelta
+
+import pandas as pd
+
+
+def cache_key(aoi, constellations, max_cloud_cover):
+    """ Hash of AOI geometry, constellations and cloud threshold
+
+    """
+
+    key = hashlib.sha1()
+    key.update(aoi.unary_union.wkb)
+    key.update(','.join(sorted(constellations)).encode())
+    key.update(str(float(max_cloud_cover)).encode())
+    return key.hexdigest()
+
+
+def load_inventory_cache(cache_dir, key):
+    """ Load cached inventory and its covered date ranges
+
+    Return:
+        (inventory GeoDataFrame or None, list of covered date ranges)
+    """
+
+    inventory_file = cache_dir.joinpath(f'{key}.pkl')
+    coverage_file = cache_dir.joinpath(f'{key}.json')
+
+    if not inventory_file.exists() or not coverage_file.exists():
+        return None, []
+
+    with open(coverage_file, 'r') as f:
+        covered = [
+            {k: dt.fromisoformat(v) for k, v in interval.items()}
+            for interval in json.load(f)
+        ]
+
+    return pd.read_pickle(inventory_file), covered
+
+
+def save_inventory_cache(cache_dir, key, gdf, covered):
+    """ Store inventory and its covered date ranges
+
+    """
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    gdf.to_pickle(cache_dir.joinpath(f'{key}.pkl'))
+
+    with open(cache_dir.joinpath(f'{key}.json'), 'w') as f:
+        json.dump(
+            [{k: v.isoformat() for k, v in interval.items()} for interval in covered],
+            f,
+            indent=2
+        )
+
+
+def missing_ranges(covered, start_date, end_date, look_back=14):
+    """ Date ranges within [start_date, end_date) not covered by the cache
+
+    Each covered range is only trusted up to look_back days before the
+    time it was queried, so that late-published scenes are picked up.
+
+    Args:
+        covered: list of dicts with start, end and queried date
+        look_back: days before the query date to search again
+    """
+
+    # effective covered ranges, sorted by start
+    trusted = sorted(
+        (
+            interval['start'],
+            min(interval['end'], interval['queried'] - timedelta(days=look_back))
+        )
+        for interval in covered
+    )
+
+    # subtract covered ranges from requested range
+    ranges, current = [], start_date
+    for start, end in trusted:
+        if end <= start or end <= current or start >= end_date:
+            continue
+        if start > current:
+            ranges.append((current, start))
+        current = max(current, end)
+
+    if current < end_date:
+        ranges.append((current, end_date))
+
+    return ranges
@@ -0,0 +1,238 @@
+import os
+import json
+import shutil
+import sqlite3
+import zipfile
+import concurrent.futures
+
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import shape
+
+import rasterio as rio
+
+
+CATALOG_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS scenes (
+        id TEXT PRIMARY KEY,
+        item_type TEXT,
+        acquired TEXT,
+        footprint TEXT,
+        bands INTEGER,
+        dtype TEXT,
+        crs TEXT,
+        width INTEGER,
+        height INTEGER,
+        path TEXT,
+        udm2_path TEXT,
+        metadata_path TEXT
+    )''',
+    '''CREATE INDEX IF NOT EXISTS scenes_acquired ON scenes (acquired)''',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS scenes_rtree USING rtree(
+        rowid, minx, maxx, miny, maxy
+    )'''
+]
+
+
+def extract_archive(archive):
+    """ Extract a delivered zip archive next to it (once)
+
+    """
+
+    out_dir = archive.with_suffix('')
+    if not out_dir.exists():
+
+        # extract to temporary folder first, so interrupted extractions are repeated
+        tmp_dir = archive.with_suffix('.extracting')
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+
+        with zipfile.ZipFile(archive) as zf:
+            zf.extractall(tmp_dir)
+        os.replace(tmp_dir, out_dir)
+
+    return out_dir
+
+
+def extract_archives(download_dir, workers=4):
+    """ Extract all delivered zip archives in parallel
+
+    """
+
+    archives = list(download_dir.glob('**/*.zip'))
+
+    # parallel execution
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            return list(executor.map(extract_archive, archives))
+
+
+def read_scene(metadata_file):
+    """ Catalog record of a delivered scene from its metadata JSON and raster header
+
+    """
+
+    with open(metadata_file, 'r') as f:
+        metadata = json.load(f)
+
+    scene_id = metadata['id']
+
+    # assets of the scene in the same folder
+    rasters = sorted(metadata_file.parent.glob(f'{scene_id}*.tif'))
+    udm2 = [raster for raster in rasters if 'udm2' in raster.name]
+    images = [raster for raster in rasters if 'udm' not in raster.name]
+
+    record = {
+        'id': scene_id,
+        'item_type': metadata['properties'].get('item_type'),
+        'acquired': metadata['properties'].get('acquired'),
+        'footprint': json.dumps(metadata['geometry']),
+        'bands': None,
+        'dtype': None,
+        'crs': None,
+        'width': None,
+        'height': None,
+        'path': str(images[0]) if images else None,
+        'udm2_path': str(udm2[0]) if udm2 else None,
+        'metadata_path': str(metadata_file)
+    }
+
+    # raster header only, no pixel data
+    if images:
+        with rio.open(images[0]) as src:
+            record.update(
+                bands=src.count,
+                dtype=src.dtypes[0],
+                crs=src.crs.to_string() if src.crs else None,
+                width=src.width,
+                height=src.height
+            )
+
+    return record
+
+
+def _read_scene(metadata_file):
+
+    # errors of single scenes should not abort the whole ingest
+    try:
+        return read_scene(metadata_file), None
+    except Exception as e:
+        return None, str(e)
+
+
+def connect(catalog_file):
+
+    con = sqlite3.connect(str(catalog_file))
+    for statement in CATALOG_SCHEMA:
+        con.execute(statement)
+
+    return con
+
+
+def ingest(download_dir, catalog_file, workers=4):
+    """ Add all delivered, not yet catalogued scenes to the local catalog
+
+    Archives are extracted and the scenes' metadata and raster headers
+    are read in parallel. Scenes that cannot be read are reported and
+    skipped.
+
+    Return:
+        number of newly catalogued scenes
+    """
+
+    # extract zip deliveries
+    extract_archives(download_dir, workers)
+
+    con = connect(catalog_file)
+    catalogued = {row[0] for row in con.execute('SELECT metadata_path FROM scenes')}
+
+    # only scenes not yet in the catalog
+    metadata_files = [
+        file for file in download_dir.glob('**/*_metadata.json')
+        if str(file) not in catalogued
+    ]
+
+    # parallel execution
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            results = list(executor.map(_read_scene, metadata_files))
+
+    records = [record for record, _ in results if record]
+    for metadata_file, (_, error) in zip(metadata_files, results):
+        if error:
+            print(f'Could not read scene {metadata_file}: {error}')
+
+    with con:
+        for record in records:
+
+            # replace earlier deliveries of the same scene
+            old = con.execute('SELECT rowid FROM scenes WHERE id = ?', (record['id'],)).fetchone()
+            if old:
+                con.execute('DELETE FROM scenes_rtree WHERE rowid = ?', old)
+                con.execute('DELETE FROM scenes WHERE rowid = ?', old)
+
+            rowid = con.execute(
+                f'INSERT INTO scenes ({", ".join(record)}) '
+                f'VALUES ({", ".join("?" * len(record))})',
+                list(record.values())
+            ).lastrowid
+
+            minx, miny, maxx, maxy = shape(json.loads(record['footprint'])).bounds
+            con.execute(
+                'INSERT INTO scenes_rtree VALUES (?, ?, ?, ?, ?)',
+                (rowid, minx, maxx, miny, maxy)
+            )
+
+    con.close()
+    return len(records)
+
+
+def query_catalog(catalog_file, start_date=None, end_date=None, aoi=None):
+    """ Query the local catalog by acquisition date and space
+
+    Args:
+        start_date, end_date: datetime or ISO date string (end exclusive)
+        aoi: GeoDataFrame/GeoSeries in EPSG:4326
+
+    Return:
+        GeoDataFrame of the matching scenes
+    """
+
+    query, params = 'SELECT s.* FROM scenes s', []
+    conditions = []
+
+    # bounding box pre-filter with the r-tree
+    if aoi is not None:
+        minx, miny, maxx, maxy = aoi.total_bounds
+        query += ' JOIN scenes_rtree r ON s.rowid = r.rowid'
+        conditions.append('r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ?')
+        params.extend([maxx, minx, maxy, miny])
+
+    if start_date is not None:
+        conditions.append('s.acquired >= ?')
+        params.append(pd.Timestamp(start_date).strftime('%Y-%m-%d'))
+
+    if end_date is not None:
+        conditions.append('s.acquired < ?')
+        params.append(pd.Timestamp(end_date).strftime('%Y-%m-%d'))
+
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    con = connect(catalog_file)
+    df = pd.read_sql_query(query + ' ORDER BY s.acquired', con, params=params)
+    con.close()
+
+    gdf = gpd.GeoDataFrame(
+        df,
+        geometry=[shape(json.loads(footprint)) for footprint in df.footprint],
+        crs='EPSG:4326'
+    )
+
+    # exact spatial filter
+    if aoi is not None:
+        gdf = gdf[gdf.intersects(aoi.unary_union)]
+
+    return gdf
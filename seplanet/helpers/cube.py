@@ -0,0 +1,177 @@
+import json
+import os
+
+import numpy as np
+
+import rasterio as rio
+from rasterio.windows import Window
+
+
+def load_index(cube_dir):
+    """ Sidecar index of a cube (dates, shape, block size, dtype, georeference)
+
+    """
+
+    index_file = cube_dir.joinpath('index.json')
+    if not index_file.exists():
+        return None
+
+    with open(index_file, 'r') as f:
+        return json.load(f)
+
+
+def _block_file(cube_dir, block_row, block_col, segment=0):
+    suffix = f'_s{segment}' if segment else ''
+    return cube_dir.joinpath(f'block_{block_row}_{block_col}{suffix}.npy')
+
+
+def _read_block(cube_dir, block_row, block_col, index, rows, cols):
+
+    # dates of a block are split into one memory-mapped segment per append
+    values = [
+        np.load(_block_file(cube_dir, block_row, block_col, segment), mmap_mode='r')[rows, cols]
+        for segment in range(len(index.get('segments', [len(index['dates'])])))
+    ]
+    return values[0] if len(values) == 1 else np.concatenate(values, axis=-1)
+
+
+def build_cube(stack_file, dates, cube_dir, block_size=256):
+    """ Export or append a time-series stack to a chunked on-disk cube
+
+    The cube is a directory of .npy blocks of block_size x block_size
+    pixels, each laid out as (row, col, time), so that the time series
+    of a pixel is contiguous and can be memory-mapped. An index.json
+    keeps dates, shape, dtype and georeference. If the cube already
+    exists, only bands with new dates are read and written as a new
+    segment of each block, existing blocks are not rewritten. Segments 
+    only become part of the cube once the index is updated at the end, 
+    so an interrupted run leaves the cube unchanged.
+
+    Args:
+        stack_file: time-series stack (e.g. stack.vrt), one band per date
+        dates: dates of the stack bands (used if bands have no description)
+
+    Return:
+        number of appended dates
+    """
+
+    cube_dir.mkdir(parents=True, exist_ok=True)
+    index = load_index(cube_dir)
+
+    with rio.open(stack_file) as src:
+
+        # dates of the stack bands
+        band_dates = [desc or date for desc, date in zip(src.descriptions, dates)]
+
+        if index is None:
+            index = {
+                'dates': [],
+                'shape': [src.height, src.width],
+                'block_size': block_size,
+                'dtype': src.dtypes[0],
+                'nodata': src.nodata,
+                'transform': list(src.transform)[:6],
+                'crs': src.crs.to_wkt() if src.crs else None
+            }
+        elif index['shape'] != [src.height, src.width]:
+            raise ValueError('Stack does not match the shape of the existing cube.')
+
+        # bands with dates not yet in the cube
+        new_bands = [
+            idx + 1 for idx, date in enumerate(band_dates) if date not in index['dates']
+        ]
+        if not new_bands:
+            return 0
+
+        # segment of this append
+        index.setdefault('segments', [len(index['dates'])] if index['dates'] else [])
+        segment = len(index['segments'])
+
+        block_size = index['block_size']
+        for block_row, row_off in enumerate(range(0, src.height, block_size)):
+            for block_col, col_off in enumerate(range(0, src.width, block_size)):
+
+                window = Window(
+                    col_off,
+                    row_off,
+                    min(block_size, src.width - col_off),
+                    min(block_size, src.height - row_off)
+                )
+
+                # (time, row, col) -> (row, col, time)
+                data = np.moveaxis(
+                    src.read(new_bands, window=window).astype(index['dtype']), 0, -1
+                )
+
+                # new segment of the block (left-overs of interrupted runs are overwritten)
+                np.save(
+                    _block_file(cube_dir, block_row, block_col, segment), 
+                    np.ascontiguousarray(data)
+                )
+
+    # commit the new segment by updating the index
+    index['dates'].extend(band_dates[band - 1] for band in new_bands)
+    index['segments'].append(len(new_bands))
+
+    tmp_file = cube_dir.joinpath('index.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_file, cube_dir.joinpath('index.json'))
+
+    return len(new_bands)
+
+
+def read_pixel(cube_dir, row, col, index=None):
+    """ Time series of a single pixel (a memory-mapped view for single-segment cubes)
+
+    Return:
+        dates, 1d array of values
+    """
+
+    index = index or load_index(cube_dir)
+    block_size = index['block_size']
+
+    return index['dates'], _read_block(
+        cube_dir, row // block_size, col // block_size, index, row % block_size, col % block_size
+    )
+
+
+def read_window(cube_dir, row_off, col_off, height, width, index=None):
+    """ Time series of a pixel window
+
+    Return:
+        dates, array of shape (height, width, time)
+    """
+
+    index = index or load_index(cube_dir)
+    block_size = index['block_size']
+
+    out = np.empty((height, width, len(index['dates'])), dtype=index['dtype'])
+    for block_row in range(row_off // block_size, (row_off + height - 1) // block_size + 1):
+        for block_col in range(col_off // block_size, (col_off + width - 1) // block_size + 1):
+
+            # overlap of window and block, in cube coordinates
+            r0 = max(row_off, block_row * block_size)
+            r1 = min(row_off + height, (block_row + 1) * block_size, index['shape'][0])
+            c0 = max(col_off, block_col * block_size)
+            c1 = min(col_off + width, (block_col + 1) * block_size, index['shape'][1])
+
+            out[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = _read_block(
+                cube_dir, block_row, block_col, index,
+                slice(r0 - block_row * block_size, r1 - block_row * block_size),
+                slice(c0 - block_col * block_size, c1 - block_col * block_size)
+            )
+
+    return index['dates'], out
+
+
+def cube_coords(index):
+    """ x and y coordinates of the pixel centers of a cube
+
+    """
+
+    a, b, c, d, e, f = index['transform']
+    rows, cols = index['shape']
+    x = c + a * (np.arange(cols) + 0.5)
+    y = f + e * (np.arange(rows) + 0.5)
+    return x, y
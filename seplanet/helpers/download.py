@@ -0,0 +1,172 @@
+import os
+import hashlib
+import concurrent.futures
+
+import backoff
+import requests
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def create_session(pool_size=16, auth=None):
+    """ HTTP session with a connection pool of pool_size keep-alive connections
+
+    """
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount('https://', adapter)
+    session.auth = auth
+
+    return session
+
+
+def md5sum(filename, chunk_size=1024*1024):
+    """ MD5 hex digest of a file, read in chunks
+
+    """
+
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def is_complete(filename, size=None, md5=None):
+    """ Check if a file is already on disk with the expected size and checksum
+
+    Without size and checksum there is nothing to verify against, so the
+    file is considered incomplete.
+    """
+
+    if not filename.exists() or (size is None and md5 is None):
+        return False
+
+    if size is not None and filename.stat().st_size != size:
+        return False
+
+    return md5 is None or md5sum(filename) == md5
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (requests.exceptions.RequestException, ChecksumError),
+    max_tries=5
+)
+def download_file(session, url, filename, size=None, md5=None, chunk_size=1024*1024):
+    """ Download url to filename, resuming partial files with range requests
+
+    Files that are already complete (same size and MD5) are skipped.
+    After the download, the MD5 is verified if given; on a mismatch the
+    file is removed and the download is retried.
+
+    Return:
+        number of bytes transferred
+    """
+
+    filename.parent.mkdir(parents=True, exist_ok=True)
+
+    if is_complete(filename, size, md5):
+        return 0
+
+    # check if file is partially downloaded (a full-size file that is not 
+    # complete failed the checksum and has to be downloaded again)
+    first_byte = filename.stat().st_size if filename.exists() else 0
+    if size is None or first_byte >= size:
+        first_byte = 0
+
+    # get byte offset for already downloaded file
+    header = {'Range': f'bytes={first_byte}-'} if first_byte else {}
+
+    transferred = 0
+    with session.get(url, headers=header, stream=True, timeout=60) as response:
+        response.raise_for_status()
+
+        # server might ignore the range header and send the full file
+        mode = 'ab' if first_byte and response.status_code == 206 else 'wb'
+
+        # actual download
+        with open(filename, mode) as file:
+            for chunk in response.iter_content(chunk_size):
+                if chunk:
+                    file.write(chunk)
+                    transferred += len(chunk)
+
+    if md5 and md5sum(filename) != md5:
+        filename.unlink()
+        raise ChecksumError(f'Checksum mismatch for {filename.name}.')
+
+    return transferred
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_tries=5)
+def get_size(session, url):
+    """ Content length of url from a HEAD request (None if unknown)
+    
+    """
+    
+    response = session.head(url, allow_redirects=True, timeout=60)
+    response.raise_for_status()
+    size = response.headers.get('content-length')
+    return int(size) if size is not None else None
+
+
+def _download_range(session, url, filename, start, end, chunk_size):
+    
+    header = {'Range': f'bytes={start}-{end}'}
+    with session.get(url, headers=header, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise requests.exceptions.RequestException('Server does not support range requests.')
+        
+        # write part at its offset
+        with open(filename, 'r+b') as file:
+            file.seek(start)
+            for chunk in response.iter_content(chunk_size):
+                if chunk:
+                    file.write(chunk)
+    
+    return end - start + 1
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_tries=5)
+def download_ranges(session, url, filename, size, parts=4, chunk_size=4*1024*1024):
+    """ Download a single large file as parts byte ranges in parallel
+    
+    The parts are written into a pre-allocated .part file, which is only 
+    renamed to filename once all ranges succeeded, so that an interrupted 
+    download never leaves a full-size file with holes behind.
+    
+    Return:
+        number of bytes transferred
+    """
+    
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    part_file = filename.with_name(filename.name + '.part')
+    
+    # pre-allocate file
+    with open(part_file, 'wb') as file:
+        file.truncate(size)
+    
+    part_size = -(-size // parts)
+    ranges = [
+        (start, min(start + part_size, size) - 1) for start in range(0, size, part_size)
+    ]
+    
+    # parallel execution
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=parts
+        ) as executor:
+            transferred = sum(executor.map(
+                lambda r: _download_range(session, url, part_file, r[0], r[1], chunk_size), 
+                ranges
+            ))
+    
+    os.replace(part_file, filename)
+    return transferred
@@ -1,8 +1,10 @@
 import json
 
+import numpy as np
+
 from shapely.ops import transform
 from shapely.wkt import loads
-from shapely.geometry import Point, Polygon, mapping, shape
+from shapely.geometry import Point, Polygon, box, mapping, shape
 from shapely.errors import WKTReadingError
 from fiona import collection
 from fiona.crs import from_epsg
@@ -16,6 +18,9 @@ import rasterio as rio
 from rasterio.crs import CRS
 import geopandas as gpd
 
+# nodata value of scaled (int16) NDVI
+NDVI_NODATA = -32768
+
 
 def wkt_to_gdf(wkt):
     """
@@ -155,24 +160,75 @@ def aoi_to_geom_dict(aoi_gdf):
     return aoi_gdf.__geo_interface__['features'][0]['geometry']
 
 
-def calculate_ndvi(infile, outfile):
+def tile_aoi(aoi_gdf, tile_size=1.0):
+    """ Split the AOI into a grid of sub-AOIs
+    
+    Args:
+        aoi_gdf: AOI as returned by aoi_to_gdf
+        tile_size: grid cell size in degrees
+        
+    Return:
+        list of single-geometry GeoSeries, one per non-empty grid cell
+    """
+    
+    aoi_geom = aoi_gdf.unary_union
+    minx, miny, maxx, maxy = aoi_geom.bounds
+    
+    tiles = []
+    for x in np.arange(minx, maxx, tile_size):
+        for y in np.arange(miny, maxy, tile_size):
+            
+            # clip grid cell to aoi
+            tile = aoi_geom.intersection(box(x, y, x + tile_size, y + tile_size))
+            if not tile.is_empty and tile.area > 0:
+                tiles.append(gpd.GeoSeries([tile], crs='epsg:4326'))
+    
+    return tiles
+
+
+def calculate_ndvi(infile, outfile, scaled=False):
+    """ NDVI of a 4-band (B, G, R, NIR) image, streamed in block windows
+    
+    Memory use is bounded by the internal block size of the input. The 
+    NDVI is computed in float32 without overflow of the uint16 sums.
+    
+    Args:
+        scaled: write int16 NDVI * 10000 with nodata -32768 instead of
+            float32 with nodata NaN
+    """
     
     date = infile.stem[:7] + '-01'
     with rio.open(infile) as src:
         
-        # read bands
-        nir = src.read(4)
-        red = src.read(3)
-        
         # copy metadata
-        outmeta = src.meta
+        outmeta = src.meta.copy()
         outmeta.update(count=1)
-        outmeta.update(dtype='float32')
-        outmeta.update(compress='lzw')
+        outmeta.update(dtype='int16' if scaled else 'float32')
+        outmeta.update(nodata=NDVI_NODATA if scaled else np.nan)
+        outmeta.update(compress='lzw', predictor=2 if scaled else 3)
+        outmeta.update(tiled=True, blockxsize=256, blockysize=256)
         outmeta.update(crs=CRS.from_epsg(3857))
         
-        ndvi = (nir-red)/(nir+red).astype('float32')
-        
         with rio.open(outfile, 'w', **outmeta) as dst:
-            dst.write(ndvi, 1)
-            dst.set_band_description(1, date)
\ No newline at end of file
+            for _, window in src.block_windows(1):
+                
+                # read bands
+                red = src.read(3, window=window).astype('float32')
+                nir = src.read(4, window=window).astype('float32')
+                
+                # ndvi in place in the nir buffer
+                denom = red + nir
+                valid = denom != 0
+                np.subtract(nir, red, out=nir)
+                np.divide(nir, denom, out=nir, where=valid)
+                
+                if scaled:
+                    ndvi = np.rint(np.multiply(nir, 10000, out=nir)).astype('int16')
+                    ndvi[~valid] = NDVI_NODATA
+                else:
+                    nir[~valid] = np.nan
+                    ndvi = nir
+                
+                dst.write(ndvi, 1, window=window)
+            
+            dst.set_band_description(1, date)
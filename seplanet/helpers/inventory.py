@@ -1,12 +1,51 @@
+import json
+import concurrent.futures
+from itertools import repeat, product
+from datetime import datetime as dt
+
 import backoff
 import planet
 from planet.api import filters
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import shape
 
 import planetpy.helpers.helpers as h
+import seplanet.helpers.cache as c
+
+# equal-area projection used for all area calculations
+EQUAL_AREA_CRS = 'EPSG:6933'
+
+# default scoring profile used by add_score
+SCORE_PROFILE = {
+    
+    # item_type score
+    'item_type': {
+        'PSScene4Band': 9, 
+        'PSScene3Band': 7, 
+        'PSOrthoTile': 8,
+        'REOrthoTile': 0,
+        'SkySatScene': 0,
+    },
+    
+    # season score
+    'months': {
+        1: 10, 7: 10,
+        2: 10, 8: 10,
+        3: 10, 9: 10,
+        4: 10, 10: 10,
+        5: 10, 11: 10,
+        6: 10, 12: 10,
+    },
+    
+    # (max. cloud cover in %, score), first match wins
+    'cloud_cover': [(0, 10), (1, 5)],
+    
+    # (min. scene overlap in %, score), first match wins
+    'scene_overlap': [(99, 10), (95, 5)],
+}
 
 def build_request(
     aoi, 
@@ -54,163 +93,490 @@ def get_items(request, client):
     
     # get each single item
     return [item for page in items_pages for item in page['features']]
-    
 
-def items_to_gdf(items):
+
+def date_shards(start_date, end_date, freq='YS'):
+    """ Split a date range into consecutive [start, end) shards
     
+    Args:
+        freq: pandas offset alias for the shard boundaries (e.g. 'YS', 'QS', 'MS')
+    """
+    
+    if not freq:
+        return [(start_date, end_date)]
     
-    items_metadata = [
-        (
-            f['properties']['acquired'],
-            f['id'], 
-            f['properties']['item_type'],
-            f['_links']['thumbnail'],
-            str(f['_permissions']),
-            f['geometry'],
-            f['properties']['cloud_cover'],
-            f
-        ) for f in items
+    # shard boundaries within the date range
+    edges = [
+        edge.to_pydatetime() for edge in pd.date_range(start_date, end_date, freq=freq)
+        if start_date < edge < end_date
     ]
     
+    edges = [start_date] + edges + [end_date]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def build_requests(
+    aoi, 
+    start_date, 
+    end_date, 
+    max_cloud_cover, 
+    constellations, 
+    shard_freq=None, 
+    split_constellations=False,
+    aoi_tile_size=None
+):
+    """ Build one search request per date (and constellation) shard
+    
+    If aoi_tile_size (in degrees) is given, the AOI is split into a grid 
+    and one request per grid cell is created as well.
+    """
+    
+    # split large aois into sub-aois
+    aois = h.tile_aoi(aoi, aoi_tile_size) if aoi_tile_size else [aoi]
+    
+    # one constellation list per shard, if split
+    constellation_shards = (
+        [[constellation] for constellation in constellations] 
+        if split_constellations else [constellations]
+    )
     
-    # Store into dataframe
-    df = pd.DataFrame(items_metadata)
-    df[0] = pd.to_datetime(df[0])
-    df.columns=[
-        'timestamp', 
-        'id', 
-        'item_type', 
-        'thumbnail', 
-        'permissions', 
-        'footprint', 
-        'cloud_cover', 
-        'metadata'
+    return [
+        build_request(sub_aoi, start, end, max_cloud_cover, constellation_shard)
+        for sub_aoi in aois
+        for start, end in date_shards(start_date, end_date, shard_freq)
+        for constellation_shard in constellation_shards
     ]
+
+
+def search_items(search_requests, client, workers=4):
+    """ Search items for a list of (sharded) requests
     
-    df.sort_values(by=['timestamp'], inplace=True)
-    df.reset_index()
+    The shards are paginated concurrently and the results are merged, 
+    deduplicated by scene id.
+    """
     
-    # get cloud cover as percentage
-    df.cloud_cover = df.cloud_cover*100
+    # parallel execution
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            shard_items = executor.map(get_items, search_requests, repeat(client))
+            
+            # merge and deduplicate by scene id
+            items = {
+                item['id']: item for items in shard_items for item in items
+            }
     
-    # add date only (without time)
-    df['date'] = df.apply(lambda row: row['timestamp'].strftime('%Y-%m-%d'), axis=1)
-    df['dove'] = df.apply(lambda row: row.id[16:], axis=1)
+    return list(items.values())
+
+
+@backoff.on_exception(backoff.expo, planet.api.exceptions.OverQuota, max_time=360)
+def _quick_search(request, client, page_size):
+    return client.quick_search(request, page_size=page_size)
+
+
+def iter_items(search_requests, client, page_size=250):
+    """ Generator over the search result pages, one list of items per page
     
-    # transform to geopandas
-    return gpd.GeoDataFrame(
-        df, geometry=df.apply(lambda row: shape(row['footprint']), axis=1)
-    )
-        
+    Pages are fetched only when consumed, so only one page is held in 
+    memory at a time. Items found by more than one request are yielded once.
+    """
     
-def add_overlaps(gdf, aoi):
+    seen = set()
+    for request in search_requests:
+        result = _quick_search(request, client, page_size)
+        for page in result.iter(None):
+            items = [
+                item for item in page.get()['features'] if item['id'] not in seen
+            ]
+            seen.update(item['id'] for item in items)
+            yield items
+
+
+def iter_inventory(
+    search_requests, 
+    client, 
+    aoi, 
+    score_profile=None, 
+    metadata_file=None, 
+    chunk_size=5000, 
+    outfile=None
+):
+    """ Generator over scored inventory chunks of about chunk_size items
+    
+    Each chunk is converted, overlapped and scored as soon as its pages 
+    arrive. If an outfile is given, chunks are appended to it as well.
+    """
     
-    def get_overlap(geom):
+    def process_chunk(items):
+        
+        gdf = items_to_gdf(items, metadata_file)
+        gdf = add_overlaps(gdf, aoi)
+        gdf = add_score(gdf, score_profile)
+        
+        # append to on-disk inventory
+        if outfile and len(gdf):
+            gdf.to_file(outfile, driver='GPKG', mode='a' if outfile.exists() else 'w')
         
-        item_shape = shape(geom)
-        scene_overlap = 100.0*(aoi_shape.intersection(item_shape).area / item_shape.area)
-        aoi_overlap = 100.0*(aoi_shape.intersection(item_shape).area / aoi.area)
-        return scene_overlap, aoi_overlap
+        return gdf
     
-    # get aoi geom
-    aoi_shape = shape(h.aoi_to_geom_dict(aoi))
+    chunk, nr_chunks = [], 0
+    for items in iter_items(search_requests, client):
+        chunk.extend(items)
+        if len(chunk) >= chunk_size:
+            yield process_chunk(chunk)
+            chunk, nr_chunks = [], nr_chunks + 1
     
-    # add overlap for each scene
-    gdf['scene_overlap'], gdf['aoi_overlap'] = zip(*gdf.apply(lambda row: get_overlap(row['geometry']), axis=1))
+    # last (or only, possibly empty) chunk
+    if chunk or not nr_chunks:
+        yield process_chunk(chunk)
+
+
+def concat_inventories(gdfs):
+    """ Concatenate inventory chunks, deduplicated by scene id (last wins)
+    
+    """
+    
+    # empty chunks would turn typed columns into object columns
+    gdfs = [gdf for gdf in gdfs if len(gdf)] or gdfs[:1]
+    gdf = pd.concat(gdfs).drop_duplicates(subset='id', keep='last')
+    
+    # restore compact dtypes after concatenation
+    for column in ['item_type', 'permissions']:
+        gdf[column] = gdf[column].astype('category')
+    
+    return gdf.sort_values(by=['timestamp'])
     
-    # extrat 2nd value that comes as tuple
-    gdf['aoi_overlap'] = gdf['aoi_overlap'].apply(lambda row: row[0])
-    return gdf
-   
 
-def add_score(gdf):
-    """Filter and score each item according to the season and item_type
+def write_metadata(items, metadata_file, mode='a'):
+    """ Append the raw item features to a JSON lines side store
+    
+    """
+    
+    with open(metadata_file, mode) as f:
+        for item in items:
+            f.write(json.dumps(item))
+            f.write('\n')
+
+
+def read_metadata(metadata_file, ids=None):
+    """ Lazily load raw item features from the JSON lines side store
+    
+    Args:
+        metadata_file: side store written by items_to_gdf/write_metadata
+        ids: optional list of scene ids to load (default: all)
     
     Return:
-        Scored items dataframe.
-        
+        dict of scene id -> raw feature
     """
     
-    def get_score(row):
-        #print(row)
-        # item_type_score
-        ITEM_TYPE_SCORE = {
-            'PSScene4Band':9, 
-            'PSScene3Band':7, 
-            'PSOrthoTile':8,
-            'REOrthoTile':0,
-            'SkySatScene':0,
-        }
+    ids = set(ids) if ids is not None else None
+    
+    metadata = {}
+    with open(metadata_file, 'r') as f:
+        for line in f:
+            item = json.loads(line)
+            if ids is None or item['id'] in ids:
+                metadata[item['id']] = item
+    
+    return metadata
 
-        # season score
-        MONTHS_SCORE = {
-            1: 10, 7:10,
-            2: 10, 8:10,
-            3: 10, 9:10,
-            4: 10, 10:10,
-            5: 10, 11:10,
-            6: 10, 12:10,
-        }
 
-        def cloud_score(cloud_cover):
-            """ Define the cloud cover threshold and score
+def items_to_gdf(items, metadata_file=None):
+    """ Turn Data API items into a compact inventory GeoDataFrame
+    
+    Only the needed properties are kept as typed columns. If a 
+    metadata_file is given, the raw features are appended there and 
+    can be loaded on demand with read_metadata.
+    """
+    
+    columns = {
+        'timestamp': [], 
+        'id': [], 
+        'item_type': [], 
+        'thumbnail': [], 
+        'permissions': [], 
+        'cloud_cover': [], 
+        'geometry': []
+    }
+    
+    # single pass over the items
+    for f in items:
+        columns['timestamp'].append(f['properties']['acquired'])
+        columns['id'].append(f['id'])
+        columns['item_type'].append(f['properties']['item_type'])
+        columns['thumbnail'].append(f['_links']['thumbnail'])
+        columns['permissions'].append(str(f['_permissions']))
+        columns['cloud_cover'].append(f['properties']['cloud_cover'])
+        columns['geometry'].append(shape(f['geometry']))
+    
+    # move raw metadata to side store
+    if metadata_file:
+        write_metadata(items, metadata_file)
+    
+    # Store into dataframe with compact dtypes (explicit, so that an 
+    # empty page or look-back window gives a correctly typed empty frame)
+    df = pd.DataFrame({
+        'timestamp': pd.to_datetime(columns['timestamp'], utc=True),
+        'id': pd.Series(columns['id'], dtype='object'),
+        'item_type': pd.Categorical(columns['item_type']),
+        'thumbnail': pd.Series(columns['thumbnail'], dtype='object'),
+        'permissions': pd.Categorical(columns['permissions']),
+        # get cloud cover as percentage
+        'cloud_cover': np.asarray(columns['cloud_cover'], dtype='float32')*100,
+    })
+    
+    # add date only (without time) and satellite id
+    df['date'] = df['timestamp'].dt.strftime('%Y-%m-%d')
+    df['dove'] = df['id'].str[16:]
+    
+    # transform to geopandas
+    gdf = gpd.GeoDataFrame(df, geometry=columns['geometry'], crs='EPSG:4326')
+    
+    gdf.sort_values(by=['timestamp'], inplace=True)
+    return gdf
+        
+    
+def _get_overlaps(footprints, aoi_geom):
+    """ Scene and AOI overlap (in percent) for a GeoSeries of footprints
+
+    Footprints and AOI geometry are expected in the same (equal-area) CRS.
+    """
+    
+    # one intersection per scene
+    intersect_area = footprints.intersection(aoi_geom).area.values
+    
+    scene_overlap = 100.0 * intersect_area / footprints.area.values
+    aoi_overlap = 100.0 * intersect_area / aoi_geom.area
+    return scene_overlap, aoi_overlap
 
-            1 = 1%
 
-            """
-           
-            if cloud_cover == 0:
-                return 10
-            elif cloud_cover <= 1 and cloud_cover > 0:
-                return 5
-            else:
-                return 0
-
-        def cover_score(covered_area):
-            """Define the cover area threshold and score
-            """
-            
-            if covered_area >= 99:
-                return 10
+def add_overlaps(gdf, aoi, chunk_size=25000, workers=None):
+    """ Add scene and AOI overlap (in percent) to the inventory
 
-            elif covered_area >= 95:
-                return 5
+    All footprints are intersected with the AOI in one call per chunk,
+    and areas are calculated in an equal-area projection. Inventories
+    larger than chunk_size are split across worker processes.
+    """
+    
+    # make sure footprints carry their lat/lon crs
+    footprints = gdf.geometry
+    if footprints.crs is None:
+        footprints = footprints.set_crs('EPSG:4326')
+    
+    # bring footprints and aoi to equal-area projection
+    footprints = footprints.to_crs(EQUAL_AREA_CRS)
+    aoi_geom = aoi.to_crs(EQUAL_AREA_CRS).unary_union
+    
+    # split into chunks
+    chunks = [
+        footprints.iloc[idx:idx+chunk_size] 
+        for idx in range(0, max(len(footprints), 1), chunk_size)
+    ]
+    
+    if len(chunks) > 1:
+        # parallel execution
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                overlaps = list(
+                    executor.map(_get_overlaps, chunks, repeat(aoi_geom))
+                )
+    else:
+        overlaps = [_get_overlaps(chunk, aoi_geom) for chunk in chunks]
+    
+    # add overlap for each scene
+    gdf['scene_overlap'] = np.concatenate([o[0] for o in overlaps])
+    gdf['aoi_overlap'] = np.concatenate([o[1] for o in overlaps])
+    return gdf
+   
 
-            else:
-                return 0
+def _score_lookup(values, thresholds, compare):
+    """ Score values by the first matching (threshold, score) breakpoint
+    
+    Values that do not match any breakpoint get a score of 0.
+    """
+    
+    conditions = [compare(values, threshold) for threshold, _ in thresholds]
+    scores = [score for _, score in thresholds]
+    return np.select(conditions, scores, default=0)
+    
+    
+def add_score(gdf, score_profile=None):
+    """Score each item according to the season, item_type, cloud cover and
+    scene overlap
+    
+    Args:
+        score_profile: dict that overrides single entries of SCORE_PROFILE
+        
+    Return:
+        Scored items dataframe.
+        
+    """
+    
+    # merge user profile with defaults, lookup tables entry by entry
+    profile = {**SCORE_PROFILE}
+    for key, value in (score_profile or {}).items():
+        if isinstance(value, dict):
+            profile[key] = {**SCORE_PROFILE.get(key, {}), **value}
+        else:
+            profile[key] = value
+    
+    # season score as lookup table by month
+    months_score = np.zeros(13)
+    for month, score in profile['months'].items():
+        months_score[month] = score
+    month_score = months_score[gdf['timestamp'].dt.month.values]
     
-        month = row['timestamp'].month
-        return MONTHS_SCORE[month] + ITEM_TYPE_SCORE[row['item_type']] + cloud_score(row['cloud_cover']) + cover_score(row['scene_overlap'])
+    # item_type score
+    item_type_score = (
+        gdf['item_type'].astype(str).map(profile['item_type']).fillna(0).values
+    )
+    
+    # cloud cover (<= threshold) and scene overlap (>= threshold) scores
+    cloud_score = _score_lookup(
+        gdf['cloud_cover'].values, profile['cloud_cover'], np.less_equal
+    )
+    cover_score = _score_lookup(
+        gdf['scene_overlap'].values, profile['scene_overlap'], np.greater_equal
+    )
     
-    gdf['total_score'] = gdf.apply(lambda row: get_score(row), axis=1)
+    gdf['total_score'] = month_score + item_type_score + cloud_score + cover_score
     gdf.sort_values(by=['total_score', 'timestamp'], ascending=False)
     return gdf
 
 
-def create_inventory(aoi, start_date, end_date, max_cloud_cover, constellations, client):
+def create_inventory(
+    aoi, 
+    start_date, 
+    end_date, 
+    max_cloud_cover, 
+    constellations, 
+    client, 
+    score_profile=None, 
+    metadata_file=None,
+    shard_freq=None,
+    split_constellations=False,
+    workers=4,
+    stream=False,
+    outfile=None,
+    aoi_tile_size=None
+):
+    
+    # create (sharded) requests
+    search_requests = build_requests(
+        aoi,  
+        start_date, 
+        end_date,  
+        max_cloud_cover, 
+        constellations,
+        shard_freq,
+        split_constellations,
+        aoi_tile_size
+    )
     
-    # create request
-    request = build_request(
-            aoi,  
-            start_date, 
-            end_date,  
-            max_cloud_cover, 
-            constellations
+    if stream:
+        # process pages into inventory chunks as they arrive
+        return concat_inventories(
+            list(iter_inventory(
+                search_requests, 
+                client, 
+                aoi, 
+                score_profile, 
+                metadata_file, 
+                outfile=outfile
+            ))
         )
     
-    # get items
-    items = get_items(request, client)
-    gdf = items_to_gdf(items)
+    if len(search_requests) > 1:
+        # get items with concurrent, sharded search
+        items = search_items(search_requests, client, workers)
+    else:
+        # get items
+        items = get_items(search_requests[0], client)
+    
+    gdf = items_to_gdf(items, metadata_file)
         
     # add overlaps
     gdf = add_overlaps(gdf, aoi)
     
     # add score
-    gdf = add_score(gdf)
+    gdf = add_score(gdf, score_profile)
         
     return gdf
 
 
+def update_inventory(
+    aoi, 
+    start_date, 
+    end_date, 
+    max_cloud_cover, 
+    constellations, 
+    client, 
+    cache_dir,
+    look_back=14,
+    score_profile=None, 
+    shard_freq=None,
+    split_constellations=False,
+    workers=4,
+    stream=False,
+    aoi_tile_size=None
+):
+    """ Incrementally update a cached inventory
+    
+    Only date ranges not yet covered by the cache (plus a look-back of 
+    look_back days for late-published scenes) are searched. Overlap and 
+    score are computed for the new items only, which are then merged 
+    into the cached inventory.
+    
+    Return:
+        inventory for the requested date range, and path to the metadata side store
+    """
+    
+    # get cache for aoi, constellations and cloud threshold
+    key = c.cache_key(aoi, constellations, max_cloud_cover)
+    cached_gdf, covered = c.load_inventory_cache(cache_dir, key)
+    metadata_file = cache_dir.joinpath(f'{key}_metadata.jsonl')
+    
+    # search only what is missing
+    queried = dt.now()
+    new_gdfs = []
+    for start, end in c.missing_ranges(covered, start_date, end_date, look_back):
+        print(f'Searching for new scenes between {start:%Y-%m-%d} and {end:%Y-%m-%d}.')
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        new_gdfs.append(create_inventory(
+            aoi,
+            start,
+            end,
+            max_cloud_cover,
+            constellations,
+            client,
+            score_profile,
+            metadata_file,
+            shard_freq,
+            split_constellations,
+            workers,
+            stream,
+            aoi_tile_size=aoi_tile_size
+        ))
+        covered.append({'start': start, 'end': end, 'queried': queried})
+    
+    if new_gdfs:
+        # merge, newer entries win
+        gdf = concat_inventories(
+            ([cached_gdf] if cached_gdf is not None else []) + new_gdfs
+        )
+        c.save_inventory_cache(cache_dir, key, gdf, covered)
+    else:
+        gdf = cached_gdf
+    
+    # subset to requested date range
+    start, end = (
+        pd.Timestamp(date).tz_localize(gdf.timestamp.dt.tz) for date in (start_date, end_date)
+    )
+    gdf = gdf[(gdf.timestamp >= start) & (gdf.timestamp < end)]
+    return gdf, metadata_file
+
+
 def refine_inventory(full_gdf, cloud_cover=100, scene_overlap=0, aoi_overlap=0, score=0, every=None):
     
     gdf = full_gdf.copy()
@@ -237,26 +603,186 @@ def refine_inventory(full_gdf, cloud_cover=100, scene_overlap=0, aoi_overlap=0,
     return gdf
 
 
-def create_composite_inventory(aoi, inventory_gdf):
+class InventoryIndex():
+    """ Precomputed sort order and period groupings of a full inventory
+    
+    Answers refine queries (thresholds and every) from arrays without 
+    copying or re-sorting the inventory on each call.
+    """
+    
+    def __init__(self, full_gdf, aoi=None):
+        
+        self.gdf = full_gdf
+        self.aoi = aoi
+        
+        # sort once, same order as in refine_inventory
+        dates = pd.to_datetime(full_gdf.timestamp.dt.date).values
+        self.order = np.lexsort((
+            full_gdf['cloud_cover'].values,
+            -full_gdf['aoi_overlap'].values,
+            -full_gdf['total_score'].values,
+            dates
+        ))
+        
+        # sorted columns used for filtering
+        self.dates = dates[self.order]
+        self.columns = {
+            column: full_gdf[column].values[self.order]
+            for column in ['cloud_cover', 'scene_overlap', 'aoi_overlap', 'total_score']
+        }
+        
+        # period groupings and equal-area footprints, filled on demand
+        self.periods = {}
+        self.footprints = None
+        
+    def period_ids(self, every):
+        """ Group id of each (sorted) scene for the given frequency
+        
+        """
+        
+        if every not in self.periods:
+            self.periods[every] = pd.Series(
+                0, index=pd.DatetimeIndex(self.dates)
+            ).groupby(pd.Grouper(freq=every)).ngroup().values
+            
+        return self.periods[every]
+    
+    def positions(self, cloud_cover=100, scene_overlap=0, aoi_overlap=0, score=0, every=None):
+        """ Row positions in the full inventory matching the refine parameters
+        
+        """
+        
+        mask = (
+            (self.columns['cloud_cover'] <= cloud_cover) &
+            (self.columns['scene_overlap'] >= scene_overlap) &
+            (self.columns['aoi_overlap'] >= aoi_overlap) &
+            (self.columns['total_score'] >= score)
+        )
+        sorted_positions = np.flatnonzero(mask)
+        
+        if every:
+            # best scene (first in sort order) per period
+            _, first = np.unique(
+                self.period_ids(every)[sorted_positions], return_index=True
+            )
+            return self.order[sorted_positions[first]]
+        
+        # keep order of full inventory
+        return np.sort(self.order[sorted_positions])
+        
+    def query(self, cloud_cover=100, scene_overlap=0, aoi_overlap=0, score=0, every=None):
+        """ Refined inventory for the given parameters
+        
+        """
+        
+        return self.gdf.iloc[
+            self.positions(cloud_cover, scene_overlap, aoi_overlap, score, every)
+        ]
+    
+    def coverage(self, positions):
+        """ Percentage of the AOI covered by the footprints at positions
+        
+        """
+        
+        if self.footprints is None:
+            footprints = self.gdf.geometry
+            if footprints.crs is None:
+                footprints = footprints.set_crs('EPSG:4326')
+            self.footprints = footprints.to_crs(EQUAL_AREA_CRS)
+            self.aoi_geom = self.aoi.to_crs(EQUAL_AREA_CRS).unary_union
+            
+        if not len(positions):
+            return 0.0
+            
+        union = self.footprints.iloc[positions].unary_union
+        return 100.0 * union.intersection(self.aoi_geom).area / self.aoi_geom.area
+    
+    def sweep(self, coverage=True, **grid):
+        """ Evaluate a grid of refine parameters
+        
+        Args:
+            coverage: calculate AOI coverage for each combination (needs aoi)
+            grid: lists of values for cloud_cover, scene_overlap, 
+                aoi_overlap, score and every
+        
+        Return:
+            DataFrame with one row per parameter combination, 
+            the number of scenes and the AOI coverage
+        """
+        
+        keys = list(grid.keys())
+        
+        results = []
+        for values in product(*[grid[key] for key in keys]):
+            params = dict(zip(keys, values))
+            positions = self.positions(**params)
+            
+            result = {**params, 'scenes': len(positions)}
+            if coverage and self.aoi is not None:
+                result['coverage'] = self.coverage(positions)
+            results.append(result)
+        
+        return pd.DataFrame(results)
+    
+    
+def _dissolve_groups(gdf):
+    """ Footprint union, date and scene ids per comb group
+    
+    """
+    
+    dissolved = gdf[['comb', 'date', 'geometry']].dissolve(by='comb', aggfunc='first')
+    dissolved['scenes'] = gdf.groupby('comb')['id'].agg(list)
+    return dissolved
 
-    df = inventory_gdf.copy()
-    df['comb'] = df.date + df.dove
 
+def create_composite_inventory(aoi, inventory_gdf, chunk_size=20000, workers=None):
+    """ Group the inventory into composites of the same date and satellite
+    
+    All groups are dissolved in one group-by pass. Inventories larger 
+    than chunk_size are split by group across worker processes.
+    
+    Return:
+        GeoDataFrame indexed by date, with scenes, aoi_intersect and geometry
+    """
+    
+    df = inventory_gdf[['id', 'date', 'dove', 'geometry']].copy()
+    df['comb'] = df.date.astype(str) + df.dove.astype(str)
+    
+    # group codes in order of appearance
+    codes, combs = pd.factorize(df.comb)
+    
+    # split groups into chunks
+    nr_chunks = -(-len(df) // chunk_size)
+    if nr_chunks > 1:
+        chunks = [chunk for _, chunk in df.groupby(codes % nr_chunks)]
+        
+        # parallel execution
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                dissolved = pd.concat(executor.map(_dissolve_groups, chunks))
+    else:
+        dissolved = _dissolve_groups(df)
+    
+    # restore order of appearance
+    composite_df = dissolved.loc[combs]
+    
     # get aoi geom
-    aoi_shape = shape(h.aoi_to_geom_dict(p.aoi))
-
-    d = {}
-    for idx in df.comb.unique():
-
-        temp_df = df[df.comb == idx]
-        date = temp_df.head(1).date.values[0]
-        scenes = list(temp_df.id.values)
-        geometry = temp_df.geometry.unary_union
-        intersect = 100 * (shape(geometry).intersection(aoi_shape).area / aoi_shape.area)
-        d[date] = {'scenes' :scenes, 'aoi_intersect': intersect, 'geometry': geometry}
-
-    composite_df = pd.DataFrame.from_dict(d, orient='index')
-    return gpd.GeoDataFrame(composite_df, geometry='geometry')
+    aoi_shape = shape(h.aoi_to_geom_dict(aoi))
+    composite_df['aoi_intersect'] = 100 * (
+        composite_df.geometry.intersection(aoi_shape).area / aoi_shape.area
+    )
+    
+    # one composite per date (last one wins, as before)
+    dates = composite_df.date.unique()
+    composite_df = composite_df.drop_duplicates(
+        subset='date', keep='last'
+    ).set_index('date').loc[dates]
+    composite_df.index.name = None
+    
+    return gpd.GeoDataFrame(
+        composite_df[['scenes', 'aoi_intersect', 'geometry']], geometry='geometry'
+    )
 
 
 def plot_inventory(aoi, inventory_df, transparency=0.05):
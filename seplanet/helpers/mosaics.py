@@ -1,150 +1,597 @@
+import json
+import time
+import hashlib
 import requests
 import concurrent.futures
+from pathlib import Path
 from datetime import datetime as dt
 
+import backoff
+
 import numpy as np
 import tqdm 
 import gdal 
+import rasterio as rio
+from rasterio.windows import Window
+from shapely.geometry import box
+
+import seplanet.helpers.download as d
+
+
+# base url of the basemaps api
+BASEMAPS_URL = 'https://api.planet.com/basemaps/v1/mosaics'
+
+
+@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_tries=5)
+def get_json(session, url, params=None):
+    
+    response = session.get(url, params=params, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_pages(session, url, key, params=None):
+    """ Walk the _next links of a paginated basemaps response
+    
+    """
+    
+    entries = []
+    while url:
+        next_fetch = get_json(session, url, params)
+        entries.extend(next_fetch[key])
+        url, params = next_fetch['_links'].get('_next'), None
+    
+    return entries
+    
+    
+def cached(cache_file, ttl, fetch):
+    """ Load json from cache_file if younger than ttl seconds, else fetch and store
+    
+    """
+    
+    if cache_file and cache_file.exists() and time.time() - cache_file.stat().st_mtime < ttl:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    
+    data = fetch()
+    
+    if cache_file:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump(data, f)
+    
+    return data
+
 
+def get_mosaic_list(session, nicfi_api_key, cache_dir=None, ttl=86400):
+    """ Get all mosaics available to the api key
+    
+    """
+    
+    return cached(
+        cache_dir.joinpath('mosaics.json') if cache_dir else None, 
+        ttl, 
+        lambda: get_pages(session, BASEMAPS_URL, 'mosaics', {'api_key': nicfi_api_key})
+    )
 
-def get_tiles(aoi, start_date, end_date, nicfi_api_key):
 
-    print(start_date, end_date)
-    # create base url
-    url = 'https://api.planet.com/basemaps/v1/mosaics?api_key=' + nicfi_api_key
+def get_mosaic_quads(session, mosaic, bbox, cache_dir=None, ttl=86400):
+    """ Get all quads of a mosaic within the bounding box
+    
+    """
+    
+    lx, ly, ux, uy = bbox
+    
+    # reformat json strings
+    url = (
+        mosaic['_links']['quads'].replace('{lx}',str(lx))
+         .replace('{ly}',str(ly))
+         .replace('{ux}',str(ux))
+         .replace('{uy}',str(uy))
+    )
+    
+    # cache per mosaic and bbox
+    bbox_hash = hashlib.sha1(str(bbox).encode()).hexdigest()[:12]
+    cache_file = (
+        cache_dir.joinpath(f'quads_{mosaic["id"]}_{bbox_hash}.json') if cache_dir else None
+    )
+    
+    return cached(cache_file, ttl, lambda: get_pages(session, url, 'items'))
+
+
+def get_tiles(aoi, start_date, end_date, nicfi_api_key, cache_dir=None, ttl=86400, workers=8):
+    """ Get the quads of all mosaics within the date range that intersect the AOI bbox
+    
+    Mosaics are paged through concurrently on one pooled session. The 
+    mosaic list and the quad listings are cached in cache_dir for ttl seconds.
+    """
     
-    # get all mosaics
-    mosaics = requests.get(url).json()['mosaics']
+    session = d.create_session(workers)
+    
+    # get all mosaics, filtered by date
+    mosaics = filter_mosaics(
+        get_mosaic_list(session, nicfi_api_key, cache_dir, ttl), start_date, end_date
+    )
+    
+    # get tile urls and metadata, in parallel
+    quads = get_quads(session, mosaics, aoi, cache_dir, ttl, workers)
+    return [tile for mosaic_quads in quads for tile in mosaic_quads]
+
 
+def filter_mosaics(mosaics, start_date, end_date):
+    
     # filter by date
-    mosaics_date_filtered = [
+    return [
         m for m in mosaics 
         if dt.strptime(m['first_acquired'][0:10], '%Y-%m-%d') >= start_date
         and dt.strptime(m['first_acquired'][0:10], '%Y-%m-%d') <= end_date
     ]
+
+
+def get_quads(session, mosaics, aoi, cache_dir=None, ttl=86400, workers=8):
+    """ Quads of each mosaic within the AOI's bbox, listed concurrently
+    
+    Return:
+        list with one list of quads per mosaic
+    """
     
     # filter by aoi's bbox
     # get bbox
-    lx, ly, ux, uy = aoi.bounds.values[0]
+    bbox = tuple(aoi.bounds.values[0])
+    
+    # parallel execution
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            return list(executor.map(
+                lambda mosaic: get_mosaic_quads(session, mosaic, bbox, cache_dir, ttl), 
+                mosaics
+            ))
 
-    # reformat json strings
-    mosaics_filtered = [
-        m['_links']['quads'].replace('{lx}',str(lx))
-         .replace('{ly}',str(ly))
-         .replace('{ux}',str(ux))
-         .replace('{uy}',str(uy))
-        for m in mosaics_date_filtered
-    ] 
+
+def tuned_workers(bandwidth=None, per_connection=50, min_workers=4, max_workers=64):
+    """ Number of parallel downloads for a link of bandwidth Mbit/s
+    
+    Assumes about per_connection Mbit/s per single connection.
+    """
     
-    # get tile urls and metadata
-    tiles, mosiacs = [], True
-    for mosaics in mosaics_filtered:
-        while mosaics:
-            next_fetch = requests.get(mosaics).json()
-            tiles.extend(next_fetch['items'])
-            try:
-                mosaics = next_fetch['_links']['_next']
-            except Exception as e:
-                mosaics = False
+    if not bandwidth:
+        return 16
     
-    return tiles
+    return int(np.clip(np.ceil(bandwidth / per_connection), min_workers, max_workers))
 
 
-def download_tiles(download_dir, tiles):
+def download_tiles(
+    download_dir, 
+    tiles, 
+    workers=None, 
+    bandwidth=None, 
+    chunk_size=4*1024*1024, 
+    split_size=None, 
+    parts=4,
+    aoi=None
+):
+    """ Download quads in parallel over a pooled keep-alive session
     
+    Args:
+        workers: number of parallel downloads (default: tuned to bandwidth)
+        bandwidth: available bandwidth in Mbit/s
+        chunk_size: read/write buffer size in bytes
+        split_size: quads larger than this (in bytes) are downloaded as 
+            parts parallel byte ranges
+        aoi: if given, only the window of each quad that intersects the 
+            AOI is read remotely and written as clipped raster
+    
+    Return:
+        list of dicts with file, bytes, seconds and error for each quad
+    """
     
     args_list, dates = [], []
     for tile in tiles:
+        download_dest, date = tile_destination(download_dir, tile)
+        args_list.append([tile['_links']['download'], download_dest])
+        dates.append(date)
+    
+    report = download_all(args_list, workers, bandwidth, chunk_size, split_size, parts, aoi)
+    
+    # create stacks for ts analysis (clipped downloads skip quads outside the aoi)
+    for tile in download_dir.glob(f'0/tile*'):
+        if any(tile.glob('*tif')):
+            build_stack(tile)
+     
+    # write dates file for ts analysis
+    write_dates(download_dir, dates)
+    return report
 
-        # get link 
-        link = tile['_links']['download']
 
-        # get metadate for filename creation
-        tilename = tile['id']
-        start = tile['_links']['thumbnail'].split('/')[6].split('_')[4]
-        end = tile['_links']['thumbnail'].split('/')[6].split('_')[5]
+def tile_destination(download_dir, tile):
+    """ Download destination and start date of a quad
+    
+    """
+    
+    # get metadate for filename creation
+    tilename = tile['id']
+    start = tile['_links']['thumbnail'].split('/')[6].split('_')[4]
+    end = tile['_links']['thumbnail'].split('/')[6].split('_')[5]
 
-        
-        # download dest
-        download_folder = download_dir.joinpath(f'0/tile_{tilename}')
-        download_folder.mkdir(parents=True, exist_ok=True)
-        download_dest = download_folder.joinpath(f'{start}_{end}_{tilename}.tif')
+    # download dest
+    download_folder = download_dir.joinpath(f'0/tile_{tilename}')
+    download_folder.mkdir(parents=True, exist_ok=True)
+    return download_folder.joinpath(f'{start}_{end}_{tilename}.tif'), start+'-01'
 
-        args_list.append([link, download_dest])
-        dates.append(start+'-01')        
+
+def download_all(
+    args_list, 
+    workers=None, 
+    bandwidth=None, 
+    chunk_size=4*1024*1024, 
+    split_size=None, 
+    parts=4,
+    aoi=None
+):
+    """ Download (url, filename) pairs in parallel, see download_tiles
+    
+    """
+    
+    workers = workers or tuned_workers(bandwidth)
+    
+    if aoi is not None:
+        # range reads of the aoi windows only, done by GDAL
+        download = lambda args: download_tile_window(args, aoi)
+    else:
+        session = d.create_session(workers * parts if split_size else workers)
+        download = lambda args: download_tile(args, session, chunk_size, split_size, parts)
     
     # parallel execution
+    started = time.time()
     with concurrent.futures.ThreadPoolExecutor(
-            max_workers=8
+            max_workers=workers
         ) as executor:
-            executor.map(download_tile, args_list)
+            report = list(executor.map(download, args_list))
+    
+    print_report(report, time.time() - started)
+    return report
+
+
+def build_stack(tile_dir, pattern='*tif', stack_name='stack.vrt', descriptions=None, nodata=0, band=None):
+    """ Build a time-series stack VRT of all files of a tile
+    
+    Args:
+        descriptions: optional band descriptions (e.g. dates), one per file
+        band: take only this band of each (multi-band) file
+    """
+    
+    filelist = [str(file) for file in sorted(tile_dir.glob(pattern))]
+    outfile = tile_dir.joinpath(stack_name)
+    opts = gdal.BuildVRTOptions(
+        srcNodata=nodata, 
+        VRTNodata=nodata, 
+        separate=True, 
+        bandList=[band] if band else None
+    )
+    vrt = gdal.BuildVRT(str(outfile), filelist, options=opts)
+    
+    # add band descriptions
+    for idx, desc in enumerate(descriptions or []):
+        vrt.GetRasterBand(idx+1).SetDescription(desc)
+    
+    vrt.FlushCache()
+    return outfile
+
+
+def is_up_to_date(outfile, infile, dtype=None, descriptions=None):
+    """ Check if outfile exists, is newer than infile and (optionally) 
+    of dtype and with the given band descriptions
+    
+    """
+    
+    if not outfile.exists() or outfile.stat().st_mtime < infile.stat().st_mtime:
+        return False
+    
+    if dtype or descriptions:
+        with rio.open(outfile) as src:
+            if dtype and src.dtypes[0] != dtype:
+                return False
+            if descriptions and list(src.descriptions) != list(descriptions):
+                return False
+    
+    return True
+
+
+def write_dates(download_dir, dates):
     
-    # create stacks for ts analysis
-    for tile in download_dir.glob(f'0/tile*'):
-        filelist = [str(file) for file in sorted(tile.glob('*tif'))]
-        outfile = tile.joinpath('stack.vrt')
-        opts = gdal.BuildVRTOptions(srcNodata=0, VRTNodata=0, separate=True)
-        vrt = gdal.BuildVRT(str(outfile), filelist, options=opts)
-        vrt.FlushCache()
-     
     # write dates file for ts analysis
     with open(download_dir.joinpath('0/dates.csv'), 'w') as f:
         for date in np.unique(sorted(dates)):
             f.write(date)
             f.write('\n')
-             
 
-def download_tile(args):
+
+def load_manifest(download_dir):
+    """ Local manifest of synced mosaics and downloaded quads
+    
+    """
+    
+    manifest_file = download_dir.joinpath('manifest.json')
+    if not manifest_file.exists():
+        return {'mosaics': {}, 'quads': {}}
+    
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+    
+
+def save_manifest(download_dir, manifest):
+    
+    with open(download_dir.joinpath('manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def sync_tiles(
+    aoi, 
+    start_date, 
+    end_date, 
+    nicfi_api_key, 
+    download_dir, 
+    cache_dir=None, 
+    ttl=86400, 
+    verify=False,
+    **download_kwargs
+):
+    """ Incrementally sync the quads of all mosaics in the date range
+    
+    A local manifest keeps track of downloaded quads (mosaic, quad id, 
+    size, timestamp) and of completely synced mosaics, per AOI bbox and 
+    clip mode. Complete mosaics are skipped without listing their quads, 
+    known quads are not touched.
+    With verify, all quads are listed and their size is checked against 
+    the server (HEAD request), and changed quads are downloaded again.
+    Stacks are only rebuilt for tiles that changed.
+    
+    Return:
+        download report (see download_tiles)
+    """
+    
+    manifest = load_manifest(download_dir)
+    session = d.create_session()
+    
+    # completeness is only valid for the same aoi bbox and clip mode
+    clipped = download_kwargs.get('aoi') is not None
+    bbox_hash = hashlib.sha1(str(tuple(aoi.bounds.values[0])).encode()).hexdigest()[:12]
+    sync_key = lambda mosaic: f'{mosaic["id"]}_{bbox_hash}_{"clip" if clipped else "full"}'
+    
+    # mosaics that are not (completely) synced yet
+    mosaics = [
+        mosaic for mosaic in filter_mosaics(
+            get_mosaic_list(session, nicfi_api_key, cache_dir, ttl), start_date, end_date
+        )
+        if verify or not manifest['mosaics'].get(sync_key(mosaic), {}).get('complete')
+    ]
+    
+    # new or changed quads
+    args_list, keys = [], []
+    for mosaic, quads in zip(mosaics, get_quads(session, mosaics, aoi, cache_dir, ttl)):
+        for tile in quads:
+            download_dest, date = tile_destination(download_dir, tile)
+            key = str(download_dest.relative_to(download_dir))
+            entry = manifest['quads'].get(key)
+            
+            if entry and download_dest.exists():
+                if entry.get('clipped', False) == clipped and (
+                    not verify or clipped or
+                    d.get_size(session, tile['_links']['download']) == entry['size']
+                ):
+                    continue
+                # changed on the server or switched clip mode
+                download_dest.unlink()
+                
+            args_list.append([tile['_links']['download'], download_dest])
+            keys.append((key, mosaic, tile, date))
+    
+    print(f'Have to download {len(args_list)} new or changed tiles.')
+    report = download_all(args_list, **download_kwargs)
+    
+    # update manifest
+    failed_mosaics = set()
+    for (key, mosaic, tile, date), result in zip(keys, report):
+        if result['error']:
+            failed_mosaics.add(mosaic['id'])
+            continue
+        if not download_dir.joinpath(key).exists():
+            # clipped quad outside the aoi geometry
+            continue
+        manifest['quads'][key] = {
+            'mosaic': mosaic['id'],
+            'quad': tile['id'],
+            'date': date,
+            'size': download_dir.joinpath(key).stat().st_size,
+            'clipped': clipped,
+            'timestamp': dt.now().isoformat()
+        }
+    
+    for mosaic in mosaics:
+        manifest['mosaics'][sync_key(mosaic)] = {
+            'mosaic': mosaic['id'],
+            'name': mosaic['name'], 
+            'complete': mosaic['id'] not in failed_mosaics
+        }
+    
+    save_manifest(download_dir, manifest)
+    
+    # rebuild stacks of changed tiles only
+    changed_tiles = {
+        download_dir.joinpath(key).parent 
+        for (key, _, _, _), result in zip(keys, report) 
+        if download_dir.joinpath(key).exists() and (
+            result['bytes'] or clipped or 
+            not download_dir.joinpath(key).parent.joinpath('stack.vrt').exists()
+        )
+    }
+    for tile_dir in changed_tiles:
+        build_stack(tile_dir)
+    
+    # dates of all synced quads
+    if changed_tiles:
+        write_dates(download_dir, [quad['date'] for quad in manifest['quads'].values()])
+    
+    return report
+
+
+def download_tile(args, session=None, chunk_size=4*1024*1024, split_size=None, parts=4):
 
     # split args
     url, filename = args
 
     if isinstance(filename, str):
         filename = Path(filename)
+    
+    session = session or d.create_session(parts)
+    
+    started = time.time()
+    try:
+        # get download size
+        total_length = d.get_size(session, url)
+        
+        if d.is_complete(filename, total_length):
+            transferred = 0
+            
+        elif split_size and total_length and total_length > split_size and not filename.exists():
+            print(f'Downloading tile: {filename.name}')
+            transferred = d.download_ranges(
+                session, url, filename, total_length, parts, chunk_size
+            )
+        
+        else:
+            # resumes partially downloaded files
+            print(f'Downloading tile: {filename.name}')
+            transferred = d.download_file(
+                session, url, filename, total_length, chunk_size=chunk_size
+            )
+        error = None
+        
+    except Exception as e:
+        transferred, error = 0, str(e)
+    
+    return {
+        'file': str(filename), 
+        'bytes': transferred, 
+        'seconds': time.time() - started, 
+        'error': error
+    }
 
-    # get first response for file Size
-    response = requests.get(url, stream=True)
-
-    # check response
-    if response.status_code != 200:
-        print(' ERROR: Something went wrong.')
-        response.raise_for_status()
-
-    # get download size
-    total_length = int(response.headers.get('content-length', 0))
-
-    # define chunk_size
-    chunk_size = 1024
 
-    # check if file is partially downloaded
-    first_byte = filename.stat().st_size if filename.exists() else 0
+def aoi_window(src, aoi):
+    """ Pixel window of a raster that covers the AOI geometry within the raster
+    
+    Return:
+        window of the bounds of the AOI and raster intersection, 
+        None if the AOI does not touch the raster
+    """
+    
+    intersection = aoi.to_crs(src.crs).unary_union.intersection(box(*src.bounds))
+    if intersection.is_empty:
+        return None
     
-    if first_byte >= total_length:
-        return
+    minx, miny, maxx, maxy = intersection.bounds
+    col0, row0 = ~src.transform * (minx, maxy)
+    col1, row1 = ~src.transform * (maxx, miny)
+    
+    # clip to raster extent
+    col0, row0 = max(0, int(np.floor(col0))), max(0, int(np.floor(row0)))
+    col1, row1 = min(src.width, int(np.ceil(col1))), min(src.height, int(np.ceil(row1)))
+    
+    if col1 <= col0 or row1 <= row0:
+        return None
+    
+    return Window(col0, row0, col1 - col0, row1 - row0)
 
-    while first_byte < total_length:
 
-        # get byte offset for already downloaded file
-        header = {"Range": f"bytes={first_byte}-{total_length}"}
+def download_tile_window(args, aoi):
+    """ Read only the AOI window of a remote quad and write it as clipped raster
+    
+    The quad is opened with GDAL's /vsicurl/, so only the internal tiles 
+    within the window are fetched with HTTP range requests.
+    """
+    
+    # split args
+    url, filename = args
 
-        print(f'Downloading tile: {filename.name}')
-        response = requests.get(
-            url, headers=header, stream=True
-        )
+    if isinstance(filename, str):
+        filename = Path(filename)
+    
+    started = time.time()
+    error = None
+    try:
+        if not filename.exists():
+            with rio.Env(
+                    GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR', 
+                    GDAL_HTTP_MULTIRANGE='YES',
+                    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES='YES',
+                    VSI_CACHE='TRUE'
+            ):
+                with rio.open(f'/vsicurl/{url}') as src:
+                    
+                    window = aoi_window(src, aoi)
+                    if window is None:
+                        # quad of the bbox listing that does not touch the AOI
+                        return {
+                            'file': str(filename), 
+                            'bytes': 0, 
+                            'seconds': time.time() - started, 
+                            'error': None
+                        }
+                        
+                    print(f'Downloading window of tile: {filename.name}')
+                    data = src.read(window=window)
+                    
+                    # copy metadata
+                    outmeta = src.meta.copy()
+                    outmeta.update(
+                        driver='GTiff',
+                        width=window.width, 
+                        height=window.height, 
+                        transform=src.window_transform(window),
+                        compress='lzw', 
+                        tiled=True, 
+                        blockxsize=256, 
+                        blockysize=256
+                    )
+                    descriptions = src.descriptions
+            
+            # write to temporary file first, so partial files are never taken as done
+            tmp_file = filename.with_suffix('.tmp')
+            with rio.open(tmp_file, 'w', **outmeta) as dst:
+                dst.write(data)
+                for band, desc in enumerate(descriptions, start=1):
+                    if desc:
+                        dst.set_band_description(band, desc)
+            tmp_file.replace(filename)
+            
+    except Exception as e:
+        error = str(e)
+    
+    # bytes transferred by GDAL's range reads are not known
+    return {
+        'file': str(filename), 
+        'bytes': 0, 
+        'seconds': time.time() - started, 
+        'error': error
+    }
 
-        # actual download
-        with open(filename, "ab") as file:
-
-            #pbar = tqdm.tqdm(
-            #    total=total_length, initial=first_byte, unit='B',
-            #    unit_scale=True, desc=' INFO: Downloading: '
-            #)
-            for chunk in response.iter_content(chunk_size):
-                if chunk:
-                    file.write(chunk)
-                    #pbar.update(chunk_size)
-        
-        #pbar.close()
 
-        # update first_byte
-        first_byte = filename.stat().st_size
+def print_report(report, seconds):
+    """ Print failures and throughput of a download run
+    
+    """
+    
+    failed = [r for r in report if r['error']]
+    transferred = sum(r['bytes'] for r in report)
+    
+    # throughput is unknown for clipped (windowed) downloads
+    throughput = (
+        f'Downloaded {transferred/1024**2:.1f} MB in {seconds:.1f} seconds '
+        f'({transferred/1024**2/max(seconds, 1e-6):.1f} MB/s), ' 
+        if transferred else f'Finished in {seconds:.1f} seconds, '
+    )
+    print(f'{throughput}{len(report) - len(failed)} of {len(report)} tiles ok.')
+    for r in failed:
+        print(f' ERROR: {r["file"]}: {r["error"]}')
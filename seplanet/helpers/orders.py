@@ -1,13 +1,18 @@
 import json
 import time
+import concurrent.futures
 from datetime import datetime as dt
 
+import numpy as np
+import pandas as pd
+import requests
 import planet
 from planet import api
 import backoff 
 
 
 import planetpy.helpers.tools as t
+import seplanet.helpers.download as d
     
     
 def build_order(aoi, inventory_gdf, title, tools, out_projection, anchor_image_id, ee_project=None, ee_collection=None):
@@ -84,6 +89,89 @@ def build_order(aoi, inventory_gdf, title, tools, out_projection, anchor_image_i
     return order_request
 
 
+def _zorder(x, y, bits=16):
+    """ Z-order (Morton) code of points, for spatial sorting
+    
+    """
+    
+    def quantize(values):
+        span = values.max() - values.min()
+        scaled = (values - values.min()) / span if span > 0 else np.zeros(len(values))
+        return (scaled * (2**bits - 1)).astype('uint64')
+    
+    qx, qy = quantize(np.asarray(x)), quantize(np.asarray(y))
+    
+    # interleave bits of x and y
+    code = np.zeros(len(qx), dtype='uint64')
+    for bit in range(bits):
+        code |= ((qx >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2*bit)
+        code |= ((qy >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2*bit + 1)
+    
+    return code
+
+
+def plan_orders(inventory_gdf, max_items=500):
+    """ Split an inventory into order chunks of at most max_items items
+    
+    Inventories of up to max_items items stay in one (multi-product) 
+    order. Larger ones are split by item type first. Within an item type, 
+    scenes are sorted by date, satellite and location (Z-order of the 
+    centroids), and scenes of the same date and satellite are kept in the 
+    same chunk whenever they fit. Chunks of different item types are 
+    merged again as long as they fit.
+    
+    Return:
+        list of GeoDataFrames
+    """
+    
+    if inventory_gdf.empty:
+        return []
+    
+    # no need to split
+    if len(inventory_gdf) <= max_items:
+        return [inventory_gdf]
+    
+    centroids = inventory_gdf.geometry.centroid
+    df = inventory_gdf.assign(
+        _zorder=_zorder(centroids.x.values, centroids.y.values)
+    ).sort_values(by=['item_type', 'date', 'dove', '_zorder'])
+    
+    chunks = []
+    for _, type_df in df.groupby('item_type', sort=False, observed=True):
+        
+        # ends of the date/satellite groups
+        group_ends = np.cumsum(
+            type_df.groupby(['date', 'dove'], sort=False).size().values
+        )
+        
+        # greedily pack whole groups, split groups larger than max_items
+        chunk_start, group_start = 0, 0
+        for group_end in group_ends:
+            if group_end - chunk_start > max_items:
+                if group_start > chunk_start:
+                    chunks.append(type_df.iloc[chunk_start:group_start])
+                    chunk_start = group_start
+                while group_end - chunk_start > max_items:
+                    chunks.append(type_df.iloc[chunk_start:chunk_start+max_items])
+                    chunk_start += max_items
+            group_start = group_end
+        
+        if chunk_start < len(type_df):
+            chunks.append(type_df.iloc[chunk_start:])
+    
+    # merge chunks of different item types (first fit, largest first)
+    merged = []
+    for chunk in sorted(chunks, key=len, reverse=True):
+        for idx, parts in enumerate(merged):
+            if sum(len(part) for part in parts) + len(chunk) <= max_items:
+                merged[idx].append(chunk)
+                break
+        else:
+            merged.append([chunk])
+    
+    return [pd.concat(parts).drop(columns='_zorder') for parts in merged]
+
+
 def get_existing_orders(client, pages=1):
     # Search all the requested orders per page
     # Fixed api.models NEXT_KEY parameter from "_next" to "next"
@@ -105,7 +193,7 @@ def get_existing_orders(client, pages=1):
 
 
 
-def place_order(client, order_request, log_dir, resubmit=False):
+def place_order(client, order_request, log_dir, resubmit=False, registry_file=None):
     
     order_title = order_request['name']
     
@@ -129,16 +217,18 @@ def place_order(client, order_request, log_dir, resubmit=False):
     
     try:
         # The following line will create the order in the server
-        @backoff.on_exception(backoff.expo,planet.api.exceptions.OverQuota, max_time=360)
-        def _place_order(_order_request):
-            return client.create_order(_order_request).get()
-
-        order_info = _place_order(order_request)
+        order_info = create_order(client, order_request)
         
         order_id = order_info['id']
         order_name = order_info['name']
 
         print(f'Order {order_id} with {order_name} has been placed.')
+        
+        # keep order id for status polling
+        if registry_file:
+            register_orders(registry_file, [order_info])
+        
+        return order_info
             
     except Exception as e:
         with open(log, 'a') as lf:
@@ -149,6 +239,128 @@ def place_order(client, order_request, log_dir, resubmit=False):
             lf.write(f'Order {order_title}: {e}\n')
             
             
+# errors after which an order request can safely be retried
+TRANSIENT_ERRORS = (
+    planet.api.exceptions.OverQuota,
+    planet.api.exceptions.TooManyRequests,
+    requests.exceptions.ConnectionError
+)
+
+
+def get_order_index(client):
+    """ Index of existing orders by name (most recent order per name)
+    
+    """
+    
+    # listing comes newest first, so older orders get overwritten
+    return {order['name']: order for order in get_existing_orders(client, None)[::-1]}
+
+
+@backoff.on_exception(backoff.expo, planet.api.exceptions.OverQuota, max_time=360)
+def create_order(client, order_request):
+    return client.create_order(order_request).get()
+
+
+def place_orders(
+    client, 
+    order_requests, 
+    log_dir, 
+    resubmit=False, 
+    registry_file=None, 
+    workers=4, 
+    max_tries=3
+):
+    """ Place several order requests concurrently
+    
+    The existing orders are fetched once to check for duplicate names.
+    Each order is retried up to max_tries times on transient errors only,
+    after checking that the failed attempt did not place the order. All 
+    results are written to one JSON lines log file.
+    
+    Return:
+        list of dicts with name, id, state and error of each order
+    """
+    
+    # check first if we already have successful orders of these names
+    order_index = get_order_index(client)
+    
+    if not resubmit:
+        placed = [
+            title for title in order_requests
+            if order_index.get(title, {}).get('state') in ['success', 'partial']
+        ]
+        if placed:
+            raise Exception(
+                f'Successful order(s) {", ".join(placed)} have been already placed. '
+                'Set resubmit option to True in case you want to re-order the images.')
+    
+    def _place_order(order_request):
+        
+        name = order_request['name']
+        for attempt in range(max_tries):
+            
+            if attempt:
+                # order creation is not idempotent, the failed attempt 
+                # might have placed the order nevertheless
+                existing = get_order_index(client).get(name)
+                if existing and existing['id'] != order_index.get(name, {}).get('id'):
+                    return existing
+                time.sleep(2 ** attempt)
+            
+            try:
+                return create_order(client, order_request)
+            except TRANSIENT_ERRORS:
+                if attempt == max_tries - 1:
+                    raise
+    
+    def place(order_request):
+        try:
+            order_info = _place_order(order_request)
+            print(f'Order {order_info["id"]} with {order_info["name"]} has been placed.')
+            return {
+                'name': order_request['name'], 
+                'id': order_info['id'], 
+                'state': order_info['state'],
+                'error': None, 
+                'order': order_info
+            }
+        except Exception as e:
+            return {
+                'name': order_request['name'], 
+                'id': None, 
+                'state': 'not placed', 
+                'error': str(e),
+                'order': None
+            }
+    
+    # parallel execution
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            results = list(executor.map(place, order_requests.values()))
+    
+    # keep order ids for status polling
+    if registry_file:
+        register_orders(registry_file, [r['order'] for r in results if r['order']])
+    
+    # one structured log for all orders
+    now = dt.now().strftime('%Y%m%d_%H_%M')
+    log = log_dir.joinpath(f'order_log_{now}.jsonl')
+    with open(log, 'a') as lf:
+        for result in results:
+            lf.write(json.dumps({k: v for k, v in result.items() if k != 'order'}))
+            lf.write('\n')
+    
+    failed = [r['name'] for r in results if r['error']]
+    if failed:
+        print(
+            f'There was an error with the order(s) {", ".join(failed)}. '
+            f'Please check the log file at {str(log)}.'
+        )
+    
+    return [{k: v for k, v in result.items() if k != 'order'} for result in results]
+
+
 def download_order(client, order_title, download_dir, log_dir):
 
     current_orders = get_existing_orders(client, None)
@@ -182,3 +394,288 @@ def download_order(client, order_title, download_dir, log_dir):
         )
         with open(log, 'w') as lf:
             lf.write(f'Order {order_title}:{e}\n')
+
+
+# orders in these states will not change anymore
+ORDER_END_STATES = ['success', 'partial', 'failed', 'cancelled']
+
+# base polling interval (in seconds) per order state, used if no fixed 
+# min_interval is given (other states are polled every 15 seconds)
+POLL_INTERVALS = {'queued': 60, 'running': 20}
+
+
+def load_registry(registry_file):
+    """ Load the local order registry (order title -> order info)
+    
+    """
+    
+    if not registry_file.exists():
+        return {}
+    
+    with open(registry_file, 'r') as f:
+        return json.load(f)
+    
+    
+def register_orders(registry_file, orders):
+    """ Add or update orders in the local order registry
+    
+    """
+    
+    registry = load_registry(registry_file)
+    for order in orders:
+        registry[order['name']] = {
+            'id': order['id'],
+            'state': order.get('state'),
+            'last_message': order.get('last_message'),
+            'created_on': order.get('created_on')
+        }
+    
+    with open(registry_file, 'w') as f:
+        json.dump(registry, f, indent=2)
+    
+    return registry
+
+
+@backoff.on_exception(backoff.expo, planet.api.exceptions.OverQuota, max_time=360)
+def get_order(client, order_id):
+    return client.get_individual_order(order_id).get()
+
+
+def get_orders_by_id(client, order_ids, workers=8):
+    """ Get the current state of several orders concurrently
+    
+    """
+    
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            return list(executor.map(lambda order_id: get_order(client, order_id), order_ids))
+
+
+def resolve_order_ids(client, registry_file, titles):
+    """ Get order ids for titles that are not yet in the registry
+    
+    The order listing is only fetched (once) if there are unknown titles.
+    """
+    
+    registry = load_registry(registry_file)
+    missing = [title for title in titles if title not in registry]
+    
+    if missing:
+        current_orders = get_existing_orders(client, None)
+        registry = register_orders(
+            registry_file, 
+            [order for order in current_orders if order['name'] in missing][::-1]
+        )
+    
+    unknown = [title for title in titles if title not in registry]
+    if unknown:
+        raise Exception(f'No orders found with the name(s) {", ".join(unknown)}.')
+    
+    return [registry[title]['id'] for title in titles]
+    
+
+def iter_order_states(client, registry_file, order_ids, min_interval=None, max_interval=300):
+    """ Generator over polling rounds, yielding the current orders of each round
+    
+    Stops after all orders reached an end state. The polling interval 
+    starts at min_interval (default: depending on the order states, see 
+    POLL_INTERVALS) and grows while nothing changes.
+    """
+    
+    interval, last_states = min_interval, None
+    while True:
+        
+        # one request per order, concurrently
+        orders = get_orders_by_id(client, order_ids)
+        register_orders(registry_file, orders)
+        yield orders
+        
+        states = [order['state'] for order in orders]
+        pending = [state for state in states if state not in ORDER_END_STATES]
+        if not pending:
+            return
+        
+        # adapt interval to order states, and back off while nothing changes
+        base = min_interval or min(POLL_INTERVALS.get(state, 15) for state in pending)
+        interval = base if states != last_states else min(max_interval, interval * 1.5)
+        last_states = states
+        
+        time.sleep(interval)
+
+
+def poll_orders(client, registry_file, titles, min_interval=None, max_interval=300):
+    """ Poll orders by id until all of them reached an end state
+    
+    """
+    
+    order_ids = resolve_order_ids(client, registry_file, titles)
+    
+    for orders in iter_order_states(client, registry_file, order_ids, min_interval, max_interval):
+        for order in orders:
+            print('Order: ' + order['name'])
+            print('Last message: ' + order['last_message'])
+    
+    return orders
+
+
+def create_session(client=None, pool_size=16):
+    """ Pooled HTTP session, authenticated with the client's api key
+    
+    """
+    
+    auth = None
+    if client is not None and getattr(client, 'auth', None):
+        auth = (client.auth.value, '')
+        
+    return d.create_session(pool_size, auth)
+
+
+def get_order_assets(session, order, download_dir):
+    """ List all files of an order delivery, with size and MD5 from its manifest
+    
+    Return:
+        list of (url, filename, size, md5) tuples
+    """
+    
+    results = order['_links'].get('results', [])
+    
+    # get checksums and sizes from manifest
+    digests = {}
+    for result in results:
+        if result['name'].endswith('manifest.json'):
+            manifest_file = download_dir.joinpath(result['name'])
+            manifest_file.unlink(missing_ok=True)
+            d.download_file(session, result['location'], manifest_file)
+            
+            with open(manifest_file, 'r') as f:
+                digests = {
+                    file['path']: (file.get('size'), file.get('digests', {}).get('md5'))
+                    for file in json.load(f)['files']
+                }
+    
+    # result names are prefixed with the order id, manifest paths are not
+    assets = []
+    for result in results:
+        if result['name'].endswith('manifest.json'):
+            continue
+        size, md5 = digests.get(result['name'].split('/', 1)[-1], (None, None))
+        assets.append((result['location'], download_dir.joinpath(result['name']), size, md5))
+    
+    return assets
+
+
+def _download_asset(session, order_id, asset):
+    
+    url, filename, size, md5 = asset
+    try:
+        transferred = d.download_file(session, url, filename, size, md5)
+        return {'order': order_id, 'file': str(filename), 'bytes': transferred, 'error': None}
+    except Exception as e:
+        return {'order': order_id, 'file': str(filename), 'bytes': 0, 'error': str(e)}
+
+
+def _log_downloads(results, log_dir):
+    
+    # one structured log for all downloads
+    failed = [result for result in results if result['error']]
+    if failed:
+        now = dt.now().strftime('%Y%m%d_%H_%M')
+        log = log_dir.joinpath(f'download_log_{now}.jsonl')
+        with open(log, 'w') as lf:
+            for result in failed:
+                lf.write(json.dumps(result))
+                lf.write('\n')
+        print(
+            f'There was an error with {len(failed)} downloads. '
+            f'Please check the log file at {str(log)}.'
+        )
+        
+
+def download_orders(client, order_ids, download_dir, log_dir, workers=8):
+    """ Download the assets of several orders concurrently
+    
+    Partial files are resumed, downloads are verified against the MD5s 
+    of the order manifest, and verified files already on disk are skipped.
+    Orders that are not (yet) successful are left out.
+    
+    Return:
+        list of dicts with order id, file, bytes transferred and error
+    """
+    
+    session = create_session(client, workers)
+    
+    # get assets of all ready orders
+    assets = []
+    for order in get_orders_by_id(client, order_ids):
+        if order['state'] not in ['success', 'partial']:
+            print(f'Order {order["name"]} is {order["state"]}, skipping download.')
+            continue
+        assets.extend(
+            (order['id'], asset) for asset in get_order_assets(session, order, download_dir)
+        )
+    
+    # parallel execution over all orders
+    print(f'Downloading {len(assets)} files.')
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            results = list(executor.map(
+                lambda args: _download_asset(session, *args), assets
+            ))
+    
+    _log_downloads(results, log_dir)
+    return results
+
+
+def watch_and_download(
+    client, 
+    registry_file, 
+    titles, 
+    download_dir, 
+    log_dir, 
+    workers=8, 
+    min_interval=None, 
+    max_interval=300
+):
+    """ Watch several orders and download each one as soon as it is ready
+    
+    Downloads of finished orders run in the background while the 
+    remaining orders are still polled.
+    
+    Return:
+        list of dicts with order id, file, bytes transferred and error
+    """
+    
+    order_ids = resolve_order_ids(client, registry_file, titles)
+    session = create_session(client, workers)
+    
+    futures, dispatched = [], set()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            
+            for orders in iter_order_states(
+                    client, registry_file, order_ids, min_interval, max_interval
+            ):
+                for order in orders:
+                    if order['id'] in dispatched or order['state'] not in ORDER_END_STATES:
+                        continue
+                    
+                    dispatched.add(order['id'])
+                    if order['state'] not in ['success', 'partial']:
+                        print(f'Order {order["name"]} {order["state"]}: {order["last_message"]}')
+                        continue
+                    
+                    # start download of this order right away
+                    assets = get_order_assets(session, order, download_dir)
+                    print(f'Order {order["name"]} is ready, downloading {len(assets)} files.')
+                    futures.extend(
+                        executor.submit(_download_asset, session, order['id'], asset)
+                        for asset in assets
+                    )
+            
+            results = [future.result() for future in futures]
+    
+    _log_downloads(results, log_dir)
+    return results
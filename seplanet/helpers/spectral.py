@@ -0,0 +1,149 @@
+import numpy as np
+
+import rasterio as rio
+from rasterio.crs import CRS
+
+from seplanet.helpers.helpers import NDVI_NODATA
+
+# spectral indices for NICFI quads (b1: blue, b2: green, b3: red, b4: nir),
+# bands are given as surface reflectance (0-1)
+INDICES = {
+    'NDVI': '(b4 - b3) / (b4 + b3)',
+    'NDWI': '(b2 - b4) / (b2 + b4)',
+    'EVI': '2.5 * (b4 - b3) / (b4 + 6 * b3 - 7.5 * b1 + 1)',
+    'SAVI': '1.5 * (b4 - b3) / (b4 + b3 + 0.5)',
+    'NIR_RED': 'b4 / b3',
+    'GREEN_RED': 'b2 / b3',
+}
+
+# indices with a bounded range, that can be stored as scaled int16 (index * 10000),
+# unbounded ones (e.g. band ratios, EVI with its near-zero denominator) are 
+# always stored as float32
+SCALED_INDICES = ['NDVI', 'NDWI', 'SAVI']
+
+# scale factor of NICFI surface reflectance
+REFLECTANCE_SCALE = 10000
+
+
+def get_expressions(indices, expressions=None):
+    """ Expressions of the requested indices
+
+    Args:
+        indices: list of index names
+        expressions: dict of custom index name -> expression, extends INDICES
+    """
+
+    available = {**INDICES, **(expressions or {})}
+    unknown = [index for index in indices if index not in available]
+    if unknown:
+        raise ValueError(f'Unknown spectral indices: {", ".join(unknown)}.')
+
+    return {index: available[index] for index in indices}
+
+
+def output_dtype(index, scaled=False):
+    """ Output data type of an index (scaled int16 only for bounded indices)
+    
+    """
+    
+    return 'int16' if scaled and index in SCALED_INDICES else 'float32'
+
+
+def calculate_indices(infile, expressions, outfiles=None, multiband_outfile=None, scaled=False):
+    """ Calculate several spectral indices from a 4-band quad in one pass
+
+    The quad is read once, block window by block window, and all
+    expressions are evaluated from the same band buffers.
+
+    Args:
+        expressions: dict of index name -> expression in b1..b4
+        outfiles: dict of index name -> single-band output file
+        multiband_outfile: one output file with one band per index
+        scaled: write int16 index * 10000 with nodata -32768 instead of
+            float32 with nodata NaN, for the bounded SCALED_INDICES only
+    """
+
+    date = infile.stem[:7] + '-01'
+    compiled = {
+        index: compile(expression, index, 'eval') for index, expression in expressions.items()
+    }
+
+    # per index output type, unbounded indices would saturate as int16
+    dtypes = {index: output_dtype(index, scaled) for index in expressions}
+    if multiband_outfile and len(set(dtypes.values())) > 1:
+        raise ValueError(
+            'Scaled multi-band output is only possible for the bounded indices '
+            f'{", ".join(SCALED_INDICES)}. Use single-band outputs or scaled=False.'
+        )
+
+    def index_meta(dtype):
+        return {
+            'dtype': dtype,
+            'nodata': NDVI_NODATA if dtype == 'int16' else np.nan,
+            'predictor': 2 if dtype == 'int16' else 3
+        }
+
+    with rio.open(infile) as src:
+
+        # copy metadata
+        outmeta = src.meta.copy()
+        outmeta.update(compress='lzw')
+        outmeta.update(tiled=True, blockxsize=256, blockysize=256)
+        outmeta.update(crs=CRS.from_epsg(3857))
+
+        # open outputs, as (dataset, band) per index
+        datasets, targets = [], {}
+        if multiband_outfile:
+            dst = rio.open(
+                multiband_outfile, 
+                'w', 
+                **{
+                    **outmeta, 
+                    **index_meta(list(dtypes.values())[0]), 
+                    'count': len(expressions)
+                }
+            )
+            datasets.append(dst)
+            for band, index in enumerate(expressions, start=1):
+                dst.set_band_description(band, index)
+                targets[index] = (dst, band)
+        else:
+            for index in expressions:
+                dst = rio.open(
+                    outfiles[index], 'w', **{**outmeta, **index_meta(dtypes[index]), 'count': 1}
+                )
+                dst.set_band_description(1, date)
+                datasets.append(dst)
+                targets[index] = (dst, 1)
+
+        try:
+            for _, window in src.block_windows(1):
+
+                # read all bands once
+                data = src.read(window=window).astype('float32')
+                valid = np.any(data != 0, axis=0)
+                data /= REFLECTANCE_SCALE
+                bands = {f'b{idx+1}': data[idx] for idx in range(data.shape[0])}
+
+                # evaluate all indices from the shared buffers
+                for index, code in compiled.items():
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        result = np.asarray(
+                            eval(code, {'__builtins__': {}, 'np': np}, bands), dtype='float32'
+                        )
+                    valid_index = valid & np.isfinite(result)
+
+                    if dtypes[index] == 'int16':
+                        # out of range values are nodata instead of saturated
+                        valid_index &= np.abs(result) <= 3.2767
+                        result = np.rint(np.where(valid_index, result, 0) * 10000).astype('int16')
+                        result[~valid_index] = NDVI_NODATA
+                    else:
+                        result[~valid_index] = np.nan
+
+                    dst, band = targets[index]
+                    dst.write(result, band, window=window)
+
+        finally:
+            for dst in datasets:
+                dst.close()
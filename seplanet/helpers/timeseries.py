@@ -0,0 +1,216 @@
+import os
+import warnings
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+
+import rasterio as rio
+from rasterio.windows import Window
+
+
+def decimal_years(dates):
+    """ Dates as decimal years
+
+    """
+
+    dates = pd.to_datetime(dates)
+    return (dates.year + (dates.dayofyear - 1) / 365.25).values.astype('float64')
+
+
+def statistic_names(percentiles=(10, 90), baseline=None):
+    """ Names of the output bands of block_statistics
+
+    """
+
+    names = ['mean', 'median'] + [f'p{p}' for p in percentiles] + ['slope']
+    if baseline:
+        names.append('anomaly')
+
+    return names + ['breakpoint', 'break_magnitude']
+
+
+def block_statistics(data, dates, percentiles=(10, 90), baseline=None, min_segment=3):
+    """ Per-pixel time-series statistics of a block
+
+    Args:
+        data: array of shape (time, rows, cols), NaN for nodata
+        dates: dates of the time axis
+        percentiles: temporal percentiles to calculate
+        baseline: (start, end) dates of the baseline period for the anomaly
+        min_segment: minimum number of observations on each side of a break
+
+    Return:
+        dict of statistic name -> 2d array (see statistic_names)
+    """
+
+    t = decimal_years(dates)[:, None, None]
+    valid = np.isfinite(data)
+    n = valid.sum(axis=0)
+
+    stats = {}
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        
+        # all-nan pixels are expected (nodata)
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        # temporal mean, median and percentiles
+        stats['mean'] = np.nanmean(data, axis=0)
+        stats['median'] = np.nanmedian(data, axis=0)
+        for p, values in zip(percentiles, np.nanpercentile(data, percentiles, axis=0)):
+            stats[f'p{p}'] = values
+
+        # linear trend (per year), least squares over valid observations
+        t_mean = np.where(valid, t, 0).sum(axis=0) / n
+        t_dev = np.where(valid, t - t_mean, 0)
+        y_dev = np.where(valid, data - stats['mean'], 0)
+        stats['slope'] = (t_dev * y_dev).sum(axis=0) / (t_dev ** 2).sum(axis=0)
+
+        # anomaly: mean after the baseline period minus baseline mean
+        if baseline:
+            start, end = decimal_years(list(baseline))
+            in_baseline = (t >= start) & (t < end)
+            stats['anomaly'] = (
+                np.nanmean(np.where(t >= end, data, np.nan), axis=0) -
+                np.nanmean(np.where(in_baseline, data, np.nan), axis=0)
+            )
+
+        # breakpoint: split with the largest (weighted) difference of segment means
+        filled = np.where(valid, data, 0)
+        cum_sum = np.cumsum(filled, axis=0)
+        cum_n = np.cumsum(valid, axis=0)
+        total_sum, total_n = cum_sum[-1], cum_n[-1]
+
+        before = cum_sum / cum_n
+        after = (total_sum - cum_sum) / (total_n - cum_n)
+        score = np.abs(after - before) * np.sqrt(cum_n * (total_n - cum_n) / total_n)
+        score[(cum_n < min_segment) | (total_n - cum_n < min_segment)] = -np.inf
+        score[~np.isfinite(score)] = -np.inf
+
+        split = np.argmax(score, axis=0)
+        found = np.take_along_axis(score, split[None], axis=0)[0] > -np.inf
+
+        # first date after the break, and change of the mean
+        t_next = np.append(t[:, 0, 0], np.nan)[np.minimum(split + 1, len(t))]
+        stats['breakpoint'] = np.where(found, t_next, np.nan)
+        stats['break_magnitude'] = np.where(
+            found,
+            np.take_along_axis(after - before, split[None], axis=0)[0],
+            np.nan
+        )
+
+    return stats
+
+
+def window_statistics(stack_file, window, dates, percentiles=(10, 90), baseline=None, scale=1.0):
+    """ Read a window of a stack and calculate its statistics
+
+    """
+
+    with rio.open(stack_file) as src:
+        data = src.read(window=window, masked=True).astype('float32').filled(np.nan)
+
+    data *= scale
+    stats = block_statistics(data, dates, percentiles, baseline)
+    return stack_file, window, stats
+
+
+def stack_windows(stack_file, block_size=256):
+
+    with rio.open(stack_file) as src:
+        return [
+            Window(
+                col_off,
+                row_off,
+                min(block_size, src.width - col_off),
+                min(block_size, src.height - row_off)
+            )
+            for row_off in range(0, src.height, block_size)
+            for col_off in range(0, src.width, block_size)
+        ]
+
+
+def _write_statistics(futures, outputs, names):
+
+    for future in concurrent.futures.as_completed(futures):
+        stack_file, window, stats = future.result()
+        dst = outputs[stack_file][0]
+        for band, name in enumerate(names, start=1):
+            dst.write(stats[name].astype('float32'), band, window=window)
+
+
+def stacks_statistics(
+    stack_files,
+    dates,
+    outname='timeseries_stats.tif',
+    block_size=256,
+    percentiles=(10, 90),
+    baseline=None,
+    scale=1.0,
+    workers=None
+):
+    """ Per-pixel time-series statistics for several tile stacks
+
+    Blocks of all tiles are processed in parallel in a process pool, with
+    at most two pending blocks per worker, so memory is bounded by
+    block_size. One tiled, multi-band GeoTIFF per stack is written next
+    to it (see statistic_names for the bands).
+
+    Args:
+        dates: dates of the stack bands (used if bands have no description)
+        scale: factor applied to the stack values (e.g. 1/10000 for scaled NDVI)
+
+    Return:
+        list of output files
+    """
+
+    names = statistic_names(percentiles, baseline)
+
+    # open one output per stack
+    outputs = {}
+    for stack_file in stack_files:
+        with rio.open(stack_file) as src:
+            stack_dates = [desc or date for desc, date in zip(src.descriptions, dates)]
+            outmeta = src.meta.copy()
+
+        outmeta.update(
+            driver='GTiff', count=len(names), dtype='float32', nodata=np.nan,
+            compress='lzw', predictor=3, tiled=True, blockxsize=256, blockysize=256
+        )
+        dst = rio.open(stack_file.parent.joinpath(outname), 'w', **outmeta)
+        for band, name in enumerate(names, start=1):
+            dst.set_band_description(band, name)
+        outputs[stack_file] = (dst, stack_dates)
+
+    # blocks of all tiles, submitted lazily
+    blocks = (
+        (stack_file, window)
+        for stack_file in stack_files
+        for window in stack_windows(stack_file, block_size)
+    )
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+
+    try:
+        # parallel execution over blocks of all tiles, with a sliding window
+        # of pending blocks, so that memory stays bounded
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                pending = set()
+                for stack_file, window in blocks:
+                    pending.add(executor.submit(
+                        window_statistics, stack_file, window, outputs[stack_file][1],
+                        percentiles, baseline, scale
+                    ))
+                    if len(pending) >= max_pending:
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        _write_statistics(done, outputs, names)
+
+                _write_statistics(pending, outputs, names)
+    finally:
+        for dst, _ in outputs.values():
+            dst.close()
+
+    return [dst.name for dst, _ in outputs.values()]
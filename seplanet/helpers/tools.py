@@ -1,7 +1,8 @@
 import json
 
 import numpy as np
-from shapely.geometry import shape
+import geopandas as gpd
+from shapely.geometry import mapping
 
 def create_toolchain(tools, aoi=None, inventory_gdf=None, anchor_image_id=None):
  
@@ -65,36 +66,92 @@ def create_toolchain(tools, aoi=None, inventory_gdf=None, anchor_image_id=None):
     return toolchain
 
 
-def select_anchor_image(inventory_gdf):
-
-    # consider images with least cloud cover (within the 10th percentile)
-    subset_gdf = inventory_gdf[inventory_gdf.cloud_cover <= np.percentile(inventory_gdf.cloud_cover, 10)]
+def simplify_aoi(aoi, max_bytes=50000):
+    """ Simplify the AOI until its GeoJSON fits into max_bytes
     
-    # now we select the image with best overlap with respectot the rest
-    final_sum = 0
-    for i in range(len(subset_gdf)):
-
-        geom = shape(subset_gdf.iloc[i].geometry)
-        _sum = inventory_gdf.apply(lambda row: row.geometry.intersection(geom).area / geom.area, axis=1).sum()
-        if _sum > final_sum:
-            final_sum = _sum
-            anchor_image_id = subset_gdf.iloc[i].id
+    The AOI is buffered by the simplification tolerance first, so the 
+    simplified geometry still covers the original one. Topology is 
+    preserved.
+    
+    Return:
+        single-geometry GeoSeries
+    """
+    
+    geom = aoi.unary_union
+    
+    def payload_size(g):
+        return len(json.dumps(mapping(g)))
+    
+    # start with a tolerance of 1/10000 of the extent, up to the extent itself
+    minx, miny, maxx, maxy = geom.bounds
+    extent = max(maxx - minx, maxy - miny)
+    tolerance = extent / 10000
+    
+    simplified = geom
+    while payload_size(simplified) > max_bytes:
+        if tolerance > extent:
+            raise ValueError(
+                f'AOI cannot be simplified to less than {max_bytes} bytes '
+                f'(smallest size: {payload_size(simplified)} bytes).'
+            )
+        simplified = geom.buffer(tolerance).simplify(tolerance, preserve_topology=True)
+        tolerance *= 2
+    
+    return gpd.GeoSeries([simplified], crs=aoi.crs)
+    
+    
+def _query_pairs(inventory_gdf, geoms):
+    """ (geometry position, inventory position) pairs of intersecting footprints
+    
+    Uses the STRtree-based spatial index of the inventory.
+    """
     
-    return anchor_image_id
+    sindex = inventory_gdf.sindex
+    query = getattr(sindex, 'query_bulk', sindex.query)
+    return query(geoms, predicate='intersects')
 
 
-def filter_coregistered_inventory(inventory_gdf, overlap_threshold=50):
+def select_anchor_image(inventory_gdf, percentile=10):
+    """ Select the anchor image with the best overlap to the rest of the inventory
+    
+    Candidates are the images with least cloud cover (within the given 
+    percentile). Their overlap sums are computed in bulk from the 
+    candidate/scene pairs found by the spatial index.
+    
+    Return:
+        anchor image id, and the anchor's overlap (in percent) for each scene
+    """
     
-    # get best anchor image
-    anchor_image_id = select_anchor_image(inventory_gdf)
+    geoms = inventory_gdf.geometry.values
     
-    # get anchor image geometry 
-    anchor_image_geom = shape(inventory_gdf[inventory_gdf.id == anchor_image_id].geometry.values[0])
+    # consider images with least cloud cover (within the 10th percentile)
+    candidates = np.flatnonzero(
+        inventory_gdf.cloud_cover.values <= np.percentile(inventory_gdf.cloud_cover, percentile)
+    )
     
-    # calculate overlap to each image
-    inventory_gdf['anchor_overlap'] = inventory_gdf.apply(
-        lambda row: 100*(row.geometry.intersection(anchor_image_geom).area / anchor_image_geom.area), axis=1
+    # overlap of each intersecting scene, relative to the candidate's area
+    cand_idx, inv_idx = _query_pairs(inventory_gdf, geoms[candidates])
+    overlaps = (
+        geoms[candidates[cand_idx]].intersection(geoms[inv_idx]).area / 
+        geoms[candidates[cand_idx]].area
     )
     
+    # select the candidate with best overlap with respect to the rest
+    sums = np.bincount(cand_idx, weights=overlaps, minlength=len(candidates))
+    best = np.argmax(sums)
+    
+    # per-scene overlap with the anchor image, 0 for non-intersecting scenes
+    anchor_overlap = np.zeros(len(inventory_gdf))
+    anchor_overlap[inv_idx[cand_idx == best]] = 100 * overlaps[cand_idx == best]
+    
+    return inventory_gdf.id.values[candidates[best]], anchor_overlap
+
+
+def filter_coregistered_inventory(inventory_gdf, overlap_threshold=50):
+    
+    # get best anchor image and overlap to each image
+    anchor_image_id, anchor_overlap = select_anchor_image(inventory_gdf)
+    inventory_gdf['anchor_overlap'] = anchor_overlap
+    
     # return anchor image and filtered collection with minimum overlap
-    return anchor_image_id, inventory_gdf[inventory_gdf.anchor_overlap >= overlap_threshold]
\ No newline at end of file
+    return anchor_image_id, inventory_gdf[inventory_gdf.anchor_overlap >= overlap_threshold]
@@ -1,13 +1,17 @@
 import time
 import shutil
+import concurrent.futures
+from itertools import repeat
 from pathlib import Path
 from datetime import datetime as dt
 
-import gdal
 from planet import api
 
 import seplanet.helpers.helpers as h
 import seplanet.helpers.mosaics as m
+import seplanet.helpers.spectral as s
+import seplanet.helpers.cube as c
+import seplanet.helpers.timeseries as t
 
 
 class Mosaics():
@@ -58,6 +62,9 @@ class Mosaics():
         print(
             f'Log files will be stored in: {self.log_dir}.'
         )
+        
+        # cache for mosaic and quad listings
+        self.cache_dir = self.project_dir.joinpath('cache')
 
         # ------------------------------------------
         # 4 handle AOI (read and get back GeoDataFrame)
@@ -71,44 +78,210 @@ class Mosaics():
         self.nicfi_api_key = nicfi_api_key
         
         
-    def get_mosaics(self):
+    def get_mosaics(self, cache_ttl=86400, workers=None, bandwidth=None, split_size=None, clip=False):
 
         # get necessary tiles to download
-        self.tileslist = m.get_tiles(self.aoi, self.start_date, self.end_date, self.nicfi_api_key)
+        self.tileslist = m.get_tiles(
+            self.aoi, self.start_date, self.end_date, self.nicfi_api_key, self.cache_dir, cache_ttl
+        )
 
         # download tiles
         print(f'Have to download {len(self.tileslist)} tiles.')
-        m.download_tiles(self.download_dir, self.tileslist)
+        self.download_report = m.download_tiles(
+            self.download_dir, 
+            self.tileslist, 
+            workers, 
+            bandwidth, 
+            split_size=split_size,
+            aoi=self.aoi if clip else None
+        )
 
     
-    def create_ndvi_timeseries(self):
+    def sync_mosaics(
+            self, 
+            cache_ttl=86400, 
+            verify=False, 
+            workers=None, 
+            bandwidth=None, 
+            split_size=None, 
+            clip=False
+    ):
+        
+        # only download new mosaics and changed quads
+        self.download_report = m.sync_tiles(
+            self.aoi, 
+            self.start_date, 
+            self.end_date, 
+            self.nicfi_api_key, 
+            self.download_dir, 
+            self.cache_dir, 
+            cache_ttl, 
+            verify,
+            workers=workers,
+            bandwidth=bandwidth,
+            split_size=split_size,
+            aoi=self.aoi if clip else None
+        )
+    
+    def create_ndvi_timeseries(self, workers=None, scaled=False):
         
+        infiles, outfiles = [], []
         for file in self.download_dir.glob('**/*.tif'):
             
             # create outfile name
             folder = self.processing_dir.joinpath('/'.join(str(file).split('/')[-3:-1]))
             folder.mkdir(parents=True, exist_ok=True)            
             outfile = folder.joinpath(f'{file.stem}.ndvi.tif')
-       
-            # calculate ndvi
-            h.calculate_ndvi(file, outfile)
             
-        # create stacks for ts analysis
+            # skip outputs that are newer than their source and of the requested type
+            if not m.is_up_to_date(outfile, file, 'int16' if scaled else 'float32'):
+                infiles.append(file)
+                outfiles.append(outfile)
+        
+        # calculate ndvi, in parallel
+        print(f'Calculating NDVI for {len(infiles)} files.')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                list(executor.map(h.calculate_ndvi, infiles, outfiles, repeat(scaled)))
+        
+        # create stacks for ts analysis, only for changed tiles
+        changed_tiles = {outfile.parent for outfile in outfiles}
         for tile in self.processing_dir.glob(f'0/tile*'):
-            filelist = [str(file) for file in sorted(tile.glob('*ndvi.tif'))]
+            if tile not in changed_tiles and tile.joinpath('stack.vrt').exists():
+                continue
+                
             datelist = [f'{file.name[:7]}-01' for file in sorted(tile.glob('*ndvi.tif'))]
-            outfile = tile.joinpath('stack.vrt')
-            opts = gdal.BuildVRTOptions(srcNodata=0, VRTNodata=0, separate=True)
-            vrt = gdal.BuildVRT(str(outfile), filelist, options=opts)
-            vrt.FlushCache()
+            m.build_stack(
+                tile, 
+                '*ndvi.tif', 
+                descriptions=datelist, 
+                nodata=h.NDVI_NODATA if scaled else 'nan'
+            )
             
-            # add date description
-            ds = gdal.Open(str(outfile), gdal.GA_Update)
-            for idx, desc in enumerate(datelist):
-                rb = ds.GetRasterBand(idx+1)
-                rb.SetDescription(desc)
-            del ds
+        # copy dates file   
+        dates_file = list(self.download_dir.glob('**/dates.csv'))[0]
+        shutil.copy(dates_file, self.processing_dir.joinpath('0/dates.csv'))
+
+    
+    def create_indices(
+            self, 
+            indices=['NDVI', 'NDWI', 'EVI', 'SAVI'], 
+            expressions=None, 
+            multiband=False, 
+            workers=None, 
+            scaled=False
+    ):
+        
+        # get expressions of requested (and custom) indices
+        expressions = s.get_expressions(indices, expressions)
+        
+        tasks = []
+        for file in self.download_dir.glob('**/*.tif'):
             
+            # create outfile names
+            folder = self.processing_dir.joinpath('/'.join(str(file).split('/')[-3:-1]))
+            folder.mkdir(parents=True, exist_ok=True)
+            if multiband:
+                outfiles = {'indices': folder.joinpath(f'{file.stem}.indices.tif')}
+                dtypes = {'indices': s.output_dtype(indices[0], scaled)}
+            else:
+                outfiles = {
+                    index: folder.joinpath(f'{file.stem}.{index.lower()}.tif') for index in indices
+                }
+                dtypes = {index: s.output_dtype(index, scaled) for index in indices}
+            
+            # skip files whose outputs are all newer than the source and of the 
+            # requested type (and, for multiband files, hold the requested indices)
+            if all(
+                m.is_up_to_date(outfile, file, dtypes[key], indices if multiband else None) 
+                for key, outfile in outfiles.items()
+            ):
+                continue
+            
+            tasks.append((
+                file, 
+                None if multiband else outfiles, 
+                outfiles['indices'] if multiband else None
+            ))
+        
+        # calculate all indices per file in one pass, in parallel
+        print(f'Calculating {", ".join(indices)} for {len(tasks)} files.')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                list(executor.map(
+                    s.calculate_indices,
+                    [task[0] for task in tasks],
+                    repeat(expressions),
+                    [task[1] for task in tasks],
+                    [task[2] for task in tasks],
+                    repeat(scaled)
+                ))
+        
+        # create per-index stacks for ts analysis, only for changed tiles
+        changed_tiles = {task[0].parent.name for task in tasks}
+        for tile in self.processing_dir.glob(f'0/tile*'):
+            for band, index in enumerate(indices, start=1):
+                stack_name = f'{index.lower()}_stack.vrt'
+                if tile.name not in changed_tiles and tile.joinpath(stack_name).exists():
+                    continue
+                
+                pattern = '*.indices.tif' if multiband else f'*.{index.lower()}.tif'
+                datelist = [f'{file.name[:7]}-01' for file in sorted(tile.glob(pattern))]
+                m.build_stack(
+                    tile, 
+                    pattern, 
+                    stack_name, 
+                    descriptions=datelist, 
+                    nodata=h.NDVI_NODATA if s.output_dtype(index, scaled) == 'int16' else 'nan',
+                    band=band if multiband else None
+                )
+        
         # copy dates file   
         dates_file = list(self.download_dir.glob('**/dates.csv'))[0]
         shutil.copy(dates_file, self.processing_dir.joinpath('0/dates.csv'))
+
+    
+    def export_cubes(self, stack_name='stack.vrt', processed=True, block_size=256):
+        
+        # processed (e.g. ndvi) or downloaded stacks
+        base_dir = self.processing_dir if processed else self.download_dir
+        
+        # dates of the time-series
+        with open(base_dir.joinpath('0/dates.csv'), 'r') as f:
+            dates = [line.strip() for line in f if line.strip()]
+        
+        # export or append each tile's stack to a chunked cube
+        for stack_file in sorted(base_dir.glob(f'0/tile*/{stack_name}')):
+            cube_dir = stack_file.parent.joinpath(f'{stack_file.stem}_cube')
+            appended = c.build_cube(stack_file, dates, cube_dir, block_size)
+            print(f'Added {appended} dates to {cube_dir}.')
+
+    
+    def timeseries_statistics(
+            self, 
+            stack_name='stack.vrt', 
+            percentiles=(10, 90), 
+            baseline=None, 
+            scale=1.0, 
+            block_size=256, 
+            workers=None
+    ):
+        
+        # dates of the time-series
+        with open(self.processing_dir.joinpath('0/dates.csv'), 'r') as f:
+            dates = [line.strip() for line in f if line.strip()]
+        
+        # per-pixel statistics over all tile stacks
+        stack_files = sorted(self.processing_dir.glob(f'0/tile*/{stack_name}'))
+        return t.stacks_statistics(
+            stack_files,
+            dates,
+            f'{stack_name.split(".")[0]}_statistics.tif',
+            block_size,
+            percentiles,
+            baseline,
+            scale,
+            workers
+        )